@@ -3,7 +3,9 @@ import click
 import json
 import logging
 import numpy as np
-from database.services import _bulk_write
+from contextlib import contextmanager
+from database.services import _bump_generation, _get_generation, _staging_table, _prepare_staging, _swap_collection, _rollback_collection, _drop_stagings
+from database.importer import BulkWriter, DeltaWriter, parse_file
 from asn.models import (
     VisPhysicalNode, 
     VisSubmarineCable, 
@@ -13,9 +15,13 @@ from asn.models import (
     VisLogicLink, 
     VisPop, 
     VisPhysicalLink,
-    VisCity
+    VisCity,
+    ENCODING_ARRAY,
+    ENCODING_BIN
 )
 from database.models import TableSelector
+from database.indexes import INDEXES, EXPLAIN_QUERIES, ensure_indexes, explain_query, index_stats
+from asn.tiles import TILE_LAYERS, build_tile
 from config import Config
 from logs import configure_log
 from extension import mongo
@@ -25,8 +31,45 @@ from collections import defaultdict
 
 
 logger = logging.getLogger("cli")
-STEP = 30
 SKIP = 1
+IMPORTED_COLLECTIONS = [collection_name for collection_name in INDEXES if collection_name not in ('vis_tiles_table', 'vis_metadata_table')]
+WRITE_STEP = 10000 # documents handed to a BulkWriter at once
+
+
+def _import_target(_table, incremental):
+    # incremental imports diff the live collection in place, full imports are written to a staging collection
+    if incremental:
+        ensure_indexes(_table)
+        return _table, DeltaWriter(_table)
+    _staging = _staging_table(_table)
+    return _staging, BulkWriter(_staging)
+
+
+@contextmanager
+def _staged(*imports):
+    # a failed import (parse or mongo error, ctrl-c) drops its partial staging collections, the live ones are kept
+    try:
+        yield
+    except BaseException:
+        _drop_stagings(*imports)
+        raise
+
+
+def _publish(*imports):
+    # (written collection, live collection, writer) triples are published together, or none of them is
+    stagings = [(_staging, _table, writer) for _staging, _table, writer in imports if _staging is not _table]
+    if not stagings:
+        if any(writer.nb_changed for _, _, writer in imports):
+            _bump_generation(TableSelector.get_metadata_table(name='default_sync'))
+        return
+    # the stagings left when publishing fails half way are dropped too, the ones already swapped in are gone
+    with _staged(*[(_staging, _table) for _staging, _table, _ in stagings]):
+        if all([_prepare_staging(_staging, _table, writer.nb_submitted) for _staging, _table, writer in stagings]):
+            for _staging, _table, _ in stagings:
+                _swap_collection(_staging, _table)
+            _bump_generation(TableSelector.get_metadata_table(name='default_sync'))
+        else:
+            _drop_stagings(*[(_staging, _table) for _staging, _table, _ in stagings])
 
 
 @click.group()
@@ -41,29 +84,23 @@ def physical_nodes():
 
 @physical_nodes.command('import')
 @click.option('--file', '-f', type=click.Path(exists=True), required=True)
-def import_physical_nodes(file):
+@click.option('--incremental', is_flag=True, help='only write the rows that changed since the last import')
+def import_physical_nodes(file, incremental):
     _table = TableSelector.get_physical_nodes_table(name='default_sync')
-    _table.delete_many({})
+    _staging, writer = _import_target(_table, incremental)
 
     nb_line = 0
-    nb_node = 0
-    op_list = list()
-    with open(file, 'r') as fp:
-        next(fp)
-        for line in fp:
-            phyical_node_obj = VisPhysicalNode.from_line(line)
-            if phyical_node_obj:
-                phyical_node_obj['index'] = nb_line
-                nb_line += 1
-            op_list.append(phyical_node_obj)
-            if len(op_list) > STEP:
-                nb_node += _bulk_write(_table, op_list)
-                op_list.clear()
-    if len(op_list) > 0:
-        nb_node += _bulk_write(_table, op_list)
-        op_list.clear()
-    
+    with _staged((_staging, _table)), writer:
+        for op_list in parse_file(file, VisPhysicalNode.from_lines, batch=True):
+            for phyical_node_obj in op_list:
+                if phyical_node_obj:
+                    phyical_node_obj['index'] = nb_line
+                    nb_line += 1
+            writer.write(op_list)
+    nb_node = writer.nb_inserted
+
     logger.info(f"{os.path.basename(file)} has {nb_line} records, {nb_node} are imported.")
+    _publish((_staging, _table, writer))
 
 
 @endpoint.group(name="submarine-cables")
@@ -73,30 +110,27 @@ def submarine_cables():
 
 @submarine_cables.command('import')
 @click.option('--file', '-f', type=click.Path(exists=True), required=True)
-def import_submarine_cable(file):
+@click.option('--incremental', is_flag=True, help='only write the rows that changed since the last import')
+@click.option('--encoding', '-e', type=click.Choice([ENCODING_ARRAY, ENCODING_BIN]), default=ENCODING_ARRAY, show_default=True,
+              help='store coordinates as arrays of doubles or as delta-encoded int32 binary (coordinates_bin)')
+def import_submarine_cable(file, incremental, encoding):
     _table = TableSelector.get_submarine_cables_table(name='default_sync')
-    _table.delete_many({})
+    _staging, writer = _import_target(_table, incremental)
 
     nb_line = 0
-    nb_cable = 0
-    op_list = list()
-
-    with open(file, 'r') as fp:
-        next(fp)
-        for line in fp:
-            cable_obj = VisSubmarineCable.from_line(line)
-            if cable_obj is not None:
-                VisSubmarineCable.fill_unknown_fields(cable_obj, nb_line)
-                nb_line += 1
-            op_list.append(cable_obj)
-            if len(op_list) > STEP:
-                nb_cable += _bulk_write(_table, op_list)
-                op_list.clear()
-    if len(op_list) > 0:
-        nb_cable += _bulk_write(_table, op_list)
-        op_list.clear()
+    with _staged((_staging, _table)), writer:
+        for op_list in parse_file(file, VisSubmarineCable.from_lines, batch=True):
+            for cable_obj in op_list:
+                if cable_obj is not None:
+                    VisSubmarineCable.fill_unknown_fields(cable_obj, nb_line)
+                    if encoding == ENCODING_BIN:
+                        VisSubmarineCable.pack_coordinates(cable_obj)
+                    nb_line += 1
+            writer.write(op_list)
+    nb_cable = writer.nb_inserted
 
     logger.info(f"{os.path.basename(file)} has {nb_line} records, {nb_cable} are imported.")
+    _publish((_staging, _table, writer))
 
 
 # @submarine_cables.command('import')
@@ -143,32 +177,24 @@ def landing_points():
 
 @landing_points.command('import')
 @click.option('--file', '-f', type=click.Path(exists=True), required=True)
-def import_landing_points(file):
+@click.option('--incremental', is_flag=True, help='only write the rows that changed since the last import')
+def import_landing_points(file, incremental):
     _table = TableSelector.get_landing_points_table(name='default_sync')
-    _table.delete_many({})
-
-    nb_line = 0
-    nb_point = 0
-    op_list = list()
+    _staging, writer = _import_target(_table, incremental)
 
-    with open(file, 'r') as fp:
-        for line in fp:
-            nb_line += 1
-            if nb_line <= SKIP:
-                continue
-            point_obj = VisLandingPoint.from_line(line)
-            # Todo: when loading file with complete information, remove fill_unknown_fields
-            if point_obj is not None:
-                VisLandingPoint.fill_unknown_fields(point_obj, nb_line)
-            op_list.append(point_obj)
-            if len(op_list) > STEP:
-                nb_point += _bulk_write(_table, op_list)
-                op_list.clear()
-    if len(op_list) > 0:
-        nb_point += _bulk_write(_table, op_list)
-        op_list.clear()
+    nb_line = SKIP
+    with _staged((_staging, _table)), writer:
+        for op_list in parse_file(file, VisLandingPoint.from_lines, skip=SKIP, batch=True):
+            for point_obj in op_list:
+                nb_line += 1
+                # Todo: when loading file with complete information, remove fill_unknown_fields
+                if point_obj is not None:
+                    VisLandingPoint.fill_unknown_fields(point_obj, nb_line)
+            writer.write(op_list)
+    nb_point = writer.nb_inserted
 
     logger.info(f"{os.path.basename(file)} has {nb_line} records, {nb_point} are imported.")
+    _publish((_staging, _table, writer))
 
 
 @endpoint.group(name="land-cables")
@@ -178,30 +204,27 @@ def land_cables():
 
 @land_cables.command('import')
 @click.option('--file', '-f', type=click.Path(exists=True), required=True)
-def import_land_cables(file):
+@click.option('--incremental', is_flag=True, help='only write the rows that changed since the last import')
+@click.option('--encoding', '-e', type=click.Choice([ENCODING_ARRAY, ENCODING_BIN]), default=ENCODING_ARRAY, show_default=True,
+              help='store coordinates as arrays of doubles or as delta-encoded int32 binary (coordinates_bin)')
+def import_land_cables(file, incremental, encoding):
     _table = TableSelector.get_land_cables_table(name='default_sync')
-    _table.delete_many({})
+    _staging, writer = _import_target(_table, incremental)
 
     nb_line = 0
-    nb_cable = 0
-    op_list = list()
-
-    with open(file, 'r') as fp:
-        next(fp)
-        for line in fp:
-            cable_obj = VisLandCable.from_line(line)
-            if cable_obj is not None:
-                VisLandCable.fill_unknown_fields(cable_obj, nb_line)
-                nb_line += 1
-            op_list.append(cable_obj)
-            if len(op_list) > STEP:
-                nb_cable += _bulk_write(_table, op_list)
-                op_list.clear()
-    if len(op_list) > 0:
-        nb_cable += _bulk_write(_table, op_list)
-        op_list.clear()
+    with _staged((_staging, _table)), writer:
+        for op_list in parse_file(file, VisLandCable.from_lines, batch=True):
+            for cable_obj in op_list:
+                if cable_obj is not None:
+                    VisLandCable.fill_unknown_fields(cable_obj, nb_line)
+                    if encoding == ENCODING_BIN:
+                        VisLandCable.pack_coordinates(cable_obj)
+                    nb_line += 1
+            writer.write(op_list)
+    nb_cable = writer.nb_inserted
 
     logger.info(f"{os.path.basename(file)} has {nb_line} records, {nb_cable} are imported.")
+    _publish((_staging, _table, writer))
 
 
 @endpoint.group(name="pop")
@@ -211,26 +234,18 @@ def pop():
 
 @pop.command('import')
 @click.option('--file', '-f', type=click.Path(exists=True), required=True)
-def load_pop(file):
+@click.option('--incremental', is_flag=True, help='only write the rows that changed since the last import')
+def load_pop(file, incremental):
     _table = TableSelector.get_pop_table(name='default_sync')
-    _table.delete_many({})
-
-    nb_pop = 0
-    op_list = list()
+    _staging, writer = _import_target(_table, incremental)
 
-    with open(file, 'r') as fp:
-        next(fp)
-        for line in fp:
-            pop_obj = VisPop.from_line(line)
-            op_list.append(pop_obj)
-            if len(op_list) > STEP:
-                nb_pop += _bulk_write(_table, op_list)
-                op_list.clear()
-    if len(op_list) > 0:
-        nb_pop += _bulk_write(_table, op_list)
-        op_list.clear()
+    with _staged((_staging, _table)), writer:
+        for op_list in parse_file(file, VisPop.from_lines, batch=True):
+            writer.write(op_list)
+    nb_pop = writer.nb_inserted
 
-    logger.info(f"{os.path.basename(file)} has {nb_pop} records.")
+    logger.info(f"{os.path.basename(file)} has {writer.nb_submitted} records, {nb_pop} are imported.")
+    _publish((_staging, _table, writer))
 
 
 @endpoint.group(name="phy-conn")
@@ -240,26 +255,18 @@ def phy_conn():
 
 @phy_conn.command('import')
 @click.option('--file', '-f', type=click.Path(exists=True), required=True)
-def load_phy_conn(file):
+@click.option('--incremental', is_flag=True, help='only write the rows that changed since the last import')
+def load_phy_conn(file, incremental):
     _table = TableSelector.get_phy_links_table(name='default_sync')
-    _table.delete_many({})
-
-    nb_link = 0
-    op_list = list()
+    _staging, writer = _import_target(_table, incremental)
 
-    with open(file, 'r') as fp:
-        next(fp)
-        for line in fp:
-            link_obj = VisPhysicalLink.from_line(line)
-            op_list.append(link_obj)
-            if len(op_list) > STEP:
-                nb_link += _bulk_write(_table, op_list)
-                op_list.clear()
-    if len(op_list) > 0:
-        nb_link += _bulk_write(_table, op_list)
-        op_list.clear()
+    with _staged((_staging, _table)), writer:
+        for op_list in parse_file(file, VisPhysicalLink.from_lines, batch=True):
+            writer.write(op_list)
+    nb_link = writer.nb_inserted
 
-    logger.info(f"{os.path.basename(file)} has {nb_link} records.")
+    logger.info(f"{os.path.basename(file)} has {writer.nb_submitted} records, {nb_link} are imported.")
+    _publish((_staging, _table, writer))
 
 
 @endpoint.group(name="logic")
@@ -270,29 +277,28 @@ def logic():
 @logic.command('import')
 @click.option('--rel-path', '-r', type=click.Path(exists=True), required=True)
 @click.option('--asrank-path', '-a', type=click.Path(exists=True), required=True)
-def load_logic_links(asrank_path, rel_path):
+@click.option('--incremental', is_flag=True, help='only write the rows that changed since the last import')
+def load_logic_links(asrank_path, rel_path, incremental):
     nb_logic_node = 0
     nb_logic_link = 0
-    nb_node_inserted = 0
-    nb_link_inserted = 0
-    op_node_list = list()
-    op_link_list = list()
     asn2idx = dict()
     link_type_mapped = {0: 'p2p', -1: 'p2c'}
     asrank_data = dict()
 
     _node_table = TableSelector.get_logic_nodes_table(name='default_sync')
     _link_table = TableSelector.get_logic_links_table(name='default_sync')
-    _node_table.delete_many({})
-    _link_table.delete_many({})
+    _node_staging, node_writer = _import_target(_node_table, incremental)
+    _link_staging, link_writer = _import_target(_link_table, incremental)
 
-    with open(asrank_path, 'r') as fp:
-        for line in fp:
-            obj = json.loads(line.strip())
+    for obj_list in parse_file(asrank_path, json.loads, skip=0):
+        for obj in obj_list:
             obj['asn'] = int(obj['asn'])
             asrank_data[obj['asn']] = obj
 
-    with open(rel_path, 'r') as fp:
+    # node indexes are assigned in order of first appearance, so the relations are walked sequentially
+    with _staged((_node_staging, _node_table), (_link_staging, _link_table)), node_writer, link_writer, open(rel_path, 'r') as fp:
+        op_node_list = list()
+        op_link_list = list()
         for line in fp:
             asn1, asn2, rel = map(int, line.strip().split(','))
             link_type = link_type_mapped[rel]
@@ -308,20 +314,18 @@ def load_logic_links(asrank_path, rel_path):
                 asn2idx[asn2] = nb_logic_node
             nb_logic_link += 1
             op_link_list.append(VisLogicLink.to_obj(nb_logic_link, asn2idx[asn1], asn2idx[asn2], link_type, src_asrank, dst_asrank))
-            if len(op_node_list) > STEP:
-                nb_node_inserted += _bulk_write(_node_table, op_node_list)
-                op_node_list.clear()
-            if len(op_link_list) > STEP:
-                nb_link_inserted += _bulk_write(_link_table, op_link_list)
-                op_link_list.clear()
-    if len(op_node_list) > 0:
-        nb_node_inserted += _bulk_write(_node_table, op_node_list)
-        op_node_list.clear()
-    if len(op_link_list) > 0:
-        nb_link_inserted += _bulk_write(_link_table, op_link_list)
-        op_link_list.clear()
+            if len(op_link_list) >= WRITE_STEP:
+                node_writer.write(op_node_list)
+                link_writer.write(op_link_list)
+                op_node_list = list()
+                op_link_list = list()
+        node_writer.write(op_node_list)
+        link_writer.write(op_link_list)
+    nb_node_inserted = node_writer.nb_inserted
+    nb_link_inserted = link_writer.nb_inserted
     logger.info(f"{os.path.basename(rel_path)} has {nb_logic_node} nodes, {nb_node_inserted} are imported.")
     logger.info(f"{os.path.basename(rel_path)} has {nb_logic_link} links, {nb_link_inserted} are imported.")
+    _publish((_node_staging, _node_table, node_writer), (_link_staging, _link_table, link_writer))
 
 
 @endpoint.group(name="city")
@@ -331,30 +335,91 @@ def city():
 
 @city.command('import')
 @click.option('--file', '-f', type=click.Path(exists=True), required=True)
-def load_city(file):
+@click.option('--incremental', is_flag=True, help='only write the rows that changed since the last import')
+def load_city(file, incremental):
     _table = TableSelector.get_city_table(name='default_sync')
-    _table.delete_many({})
+    _staging, writer = _import_target(_table, incremental)
 
     idx = 0
-    nb_city = 0
-    op_list = list()
+    with _staged((_staging, _table)), writer:
+        for op_list in parse_file(file, VisCity.from_lines, batch=True):
+            for city_obj in op_list:
+                if city_obj is not None:
+                    VisCity.fill_unknown_fields(city_obj, idx)
+                    idx += 1
+            writer.write(op_list)
+    nb_city = writer.nb_inserted
 
-    with open(file, 'r') as fp:
-        next(fp)
-        for line in fp:
-            city_obj = VisCity.from_line(line)
-            if city_obj is not None:
-                VisCity.fill_unknown_fields(city_obj, idx)
-                idx += 1
-            op_list.append(city_obj)
-            if len(op_list) > STEP:
-                nb_city += _bulk_write(_table, op_list)
-                op_list.clear()
-    if len(op_list) > 0:
-        nb_city += _bulk_write(_table, op_list)
-        op_list.clear()
-
-    logger.info(f"{os.path.basename(file)} has {nb_city} records.")
+    logger.info(f"{os.path.basename(file)} has {writer.nb_submitted} records, {nb_city} are imported.")
+    _publish((_staging, _table, writer))
+
+
+@endpoint.group(name="indexes")
+def indexes():
+    pass
+
+
+@indexes.command('ensure')
+def create_indexes():
+    for collection_name in INDEXES:
+        _table = TableSelector.get_table(collection_name, name='default_sync')
+        names = ensure_indexes(_table)
+        logger.info(f"{collection_name} has indexes: {names}")
+
+
+@indexes.command('stats')
+@click.option('--explain/--no-explain', default=True, help='also explain the representative queries of the api')
+def show_index_stats(explain):
+    for collection_name in INDEXES:
+        _table = TableSelector.get_table(collection_name, name='default_sync')
+        click.echo(f"{collection_name}:")
+        for stats in index_stats(_table):
+            click.echo(f"  index {stats['name']}: {stats['accesses']['ops']} ops since {stats['accesses']['since']}")
+        if not explain:
+            continue
+        for query_params, sort in EXPLAIN_QUERIES.get(collection_name, []):
+            res = explain_query(_table, query_params, sort)
+            click.echo(f"  query {query_params} sort {sort}: {' <- '.join(res['stages'])}, "
+                       f"keys examined {res['keys_examined']}, docs examined {res['docs_examined']}, returned {res['returned']}")
+
+
+@endpoint.group(name="collections")
+def collections():
+    pass
+
+
+@collections.command('rollback')
+@click.option('--collection', '-c', type=click.Choice(IMPORTED_COLLECTIONS), multiple=True, required=True,
+              help='logic imports write vis_logic_nodes_table and vis_logic_links_table, roll both back')
+def rollback_collections(collection):
+    rolled_back = [_rollback_collection(TableSelector.get_table(collection_name, name='default_sync'))
+                   for collection_name in collection]
+    if any(rolled_back):
+        _bump_generation(TableSelector.get_metadata_table(name='default_sync'))
+
+
+@endpoint.group(name="tiles")
+def tiles():
+    pass
+
+
+@tiles.command('precompute')
+@click.option('--layer', '-l', type=click.Choice(list(TILE_LAYERS)), multiple=True, help='defaults to all layers')
+@click.option('--max-zoom', '-z', type=int, default=4, show_default=True)
+def precompute_tiles(layer, max_zoom):
+    generation = _get_generation(TableSelector.get_metadata_table(name='default_sync'))
+    _tiles = TableSelector.get_tiles_table(name='default_sync')
+    ensure_indexes(_tiles)
+    _tiles.delete_many({'generation': {'$ne': generation}})
+    for _layer in (layer or TILE_LAYERS):
+        nb_tile = 0
+        nb_bytes = 0
+        for z in range(max_zoom + 1):
+            for x in range(2 ** z):
+                for y in range(2 ** z):
+                    nb_bytes += build_tile(_layer, z, x, y, generation)
+                    nb_tile += 1
+        logger.info(f"{_layer} has {nb_tile} tiles up to zoom {max_zoom}, {nb_bytes} bytes, generation {generation}.")
 
 
 def configure():
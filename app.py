@@ -20,6 +20,8 @@ from fastapi.middleware.cors import CORSMiddleware
 from extension import (
     mongo
 )
+from database.models import TableSelector
+from database.indexes import INDEXES, ensure_indexes_async
 from config import Config
 
 
@@ -67,6 +69,13 @@ def configure_database():
     mongo.load_config(conf['MONGO_MAP'])
 
 
+@app.on_event("startup")
+async def configure_indexes():
+    # create_indexes is a no-op for indexes that already exist
+    for collection_name in INDEXES:
+        await ensure_indexes_async(TableSelector.get_table(collection_name))
+
+
 def configure_routers():
     router_path = 'asn'
     router = 'router'
@@ -0,0 +1,92 @@
+import time
+import logging
+from collections import OrderedDict
+from config import Config
+from database.models import TableSelector
+
+
+logger = logging.getLogger('asn.cache')
+
+
+class ResponseCache:
+    """
+    LRU cache of serialized responses, stored as (content, media_type, headers) and
+    bounded by number of entries and total bytes of content. Entries expire after `ttl` seconds and the whole cache is dropped as soon as
+    the data generation stored in mongo changes (see database.services._bump_generation).
+    """
+
+    def __init__(self, max_entries, max_bytes, ttl, check_interval):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.check_interval = check_interval
+        self.nb_bytes = 0
+        self.generation = None
+        self.checked_at = 0.0
+        self.__entries: OrderedDict = OrderedDict()
+
+    def __len__(self):
+        return len(self.__entries)
+
+    @staticmethod
+    def make_key(args):
+        params = tuple(sorted(
+            (k, ','.join(p.strip() for p in v.split(','))) for k, v in args.model_dump().items() if v
+        ))
+        return type(args).__name__, params
+
+    def get(self, key):
+        item = self.__entries.get(key)
+        if item is None:
+            return None
+        expire_at, response = item
+        if expire_at < time.monotonic():
+            self.pop(key)
+            return None
+        self.__entries.move_to_end(key)
+        return response
+
+    def set(self, key, content: bytes, media_type: str, headers=None, generation=None):
+        # `generation` is the one the response was read under, a response read before
+        # the generation moved is stale and not cached
+        size = len(content)
+        if size > self.max_bytes or (generation is not None and generation != self.generation):
+            return
+        self.pop(key)
+        self.__entries[key] = (time.monotonic() + self.ttl, (content, media_type, headers))
+        self.nb_bytes += size
+        while len(self.__entries) > self.max_entries or self.nb_bytes > self.max_bytes:
+            _, (_, evicted) = self.__entries.popitem(last=False)
+            self.nb_bytes -= len(evicted[0])
+
+    def pop(self, key):
+        item = self.__entries.pop(key, None)
+        if item is not None:
+            self.nb_bytes -= len(item[1][0])
+
+    def clear(self):
+        self.__entries.clear()
+        self.nb_bytes = 0
+
+    async def validate(self):
+        # the generation lookup costs a round trip, so it is done at most once per interval
+        now = time.monotonic()
+        if now - self.checked_at < self.check_interval:
+            return
+        self.checked_at = now
+        _table = TableSelector.get_metadata_table()
+        doc = await _table.find_one({'key': 'generation'}, {'_id': 0, 'value': 1})
+        generation = doc['value'] if doc else 0
+        if generation != self.generation:
+            if self.generation is not None:
+                logger.info(f'data generation changed from {self.generation} to {generation}, drop {len(self)} cached responses')
+            self.clear()
+            self.generation = generation
+
+
+response_cache = ResponseCache(
+    Config.RESPONSE_CACHE_MAX_ENTRIES,
+    Config.RESPONSE_CACHE_MAX_BYTES,
+    Config.RESPONSE_CACHE_TTL,
+    Config.RESPONSE_CACHE_CHECK_INTERVAL,
+)
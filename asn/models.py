@@ -1,24 +1,132 @@
 import json
 import logging
 import traceback
+from functools import lru_cache
 from pydantic import BaseModel
 from datetime import datetime
-from utils.conversion import to_float, split_string, parse_wkt_multilinestring, parse_wkt_linestring
+from typing import Optional
+import shapely
+from utils.conversion import to_float, split_string, split_lines, parse_wkt_multilinestring, parse_wkt_linestring, to_geojson_point, to_bbox, simplify_line, LOD_TOLERANCES
+from utils.conversion import parse_geometries, split_parts, part_coordinates, lines_to_list, encode_coordinates, decode_coordinates
 
 
 
 logger = logging.getLogger("asn.models")
 KEEP_DIGITS = 4
 DATE_FORMAT = "%Y-%m-%d"
+ENCODING_ARRAY = 'array'
+ENCODING_BIN = 'bin'
 TODAY_STR = datetime.now().strftime(DATE_FORMAT)
 
 
+@lru_cache(maxsize=4096)
+def _parse_date(value):
+    # a dataset only has a handful of distinct dates, strptime is the slowest step of a row
+    return datetime.strptime(value, DATE_FORMAT)
+
+
+def _strip_quote(value):
+    return value.strip("\"")
+
+
+def _round_float(value):
+    return round(float(value), KEEP_DIGITS)
+
+
+def _to_index(value):
+    return int(value.strip('N'))
+
+
+def _to_int_list(value):
+    return [int(i) for i in value.strip().split(',')] if value != '' else []
+
+
+def _convert_column(values, convert):
+    # the whole column is converted at once, only a failing column is retried value by value to find the bad rows
+    try:
+        return [convert(value) for value in values], {}
+    except Exception:
+        pass
+    column = list()
+    errors = dict()
+    for i, value in enumerate(values):
+        try:
+            column.append(convert(value))
+        except Exception as e:
+            column.append(None)
+            errors[i] = e
+    return column, errors
+
+
+def _split_columns(lines, keys, converters):
+    """
+    Split `lines` with one csv reader and convert their columns with `converters` (key -> function of a value).
+    Returns the positions of the lines that parsed and their columns in `keys` order, the other lines are logged.
+    """
+    rows = split_lines(lines)
+    positions = list()
+    for pos, row in enumerate(rows):
+        if row is not None and len(row) >= len(keys):
+            positions.append(pos)
+        else:
+            logger.error('Fail when processing line: %s, err: expect %d fields', lines[pos], len(keys))
+    columns = [list(column) for column in zip(*(rows[pos][:len(keys)] for pos in positions))] or [[] for _ in keys]
+    failed = dict()
+    for i, key in enumerate(keys):
+        if key not in converters:
+            continue
+        columns[i], errors = _convert_column(columns[i], converters[key])
+        for j, e in errors.items():
+            failed.setdefault(j, f'{key}: {e}')
+    if failed:
+        for j, err in sorted(failed.items()):
+            logger.error('Fail when processing line: %s, err: %s', lines[positions[j]], err)
+        keep = [j for j in range(len(positions)) if j not in failed]
+        positions = [positions[j] for j in keep]
+        columns = [[column[j] for j in keep] for column in columns]
+    return positions, columns
+
+
+def _line_geometries(lines, positions, values, geom_type, fallback):
+    """
+    Parse a whole column of WKT (multi)linestrings with shapely's vectorized reader and build the coordinates,
+    bbox and simplified coordinates of every row at once. Rows the vectorized path can not take (e.g. a part with
+    a single point) go through `fallback`, the per-row parser, and None is returned for the rows that fail there too.
+    """
+    wkts = [value.strip("\"") for value in values]
+    geoms = parse_geometries([wkt if wkt.startswith(geom_type) else None for wkt in wkts])
+    parts, offsets = split_parts(geoms)
+    multi = geom_type == "MULTILINESTRING"
+    coordinates = part_coordinates(parts, offsets, as_list=True)
+    bounds = shapely.bounds(geoms).tolist()
+    lods = {lod: part_coordinates(parts, offsets, tolerance, as_list=True) for lod, tolerance in LOD_TOLERANCES.items()}
+    geometries = list()
+    for i, value in enumerate(values):
+        if geoms[i] is None or offsets[i] == offsets[i + 1]:
+            try:
+                geometries.append(fallback(value))
+            except Exception as e:
+                logger.error('Fail when processing line: %s, err: coordinates: %s', lines[positions[i]], e)
+                geometries.append(None)
+            continue
+        west, south, east, north = bounds[i]
+        geometry = {
+            "coordinates": coordinates[i] if multi else coordinates[i][0],
+            "bbox": {'west': west, 'south': south, 'east': east, 'north': north},
+        }
+        for lod in LOD_TOLERANCES:
+            geometry[f'coordinates_{lod}'] = lods[lod][i] if multi else lods[lod][i][0]
+        geometries.append(geometry)
+    return geometries
+
+
 class VisPhysicalNode(BaseModel):
     index: int
     name: str
     organization: str
     latitude: float
     longitude: float
+    location: Optional[dict]
     city: str
     state: str
     country: str
@@ -45,6 +153,7 @@ class VisPhysicalNode(BaseModel):
                 "organization": _organization,
                 "latitude": _latitude,
                 "longitude": _longitude,
+                "location": to_geojson_point(_latitude, _longitude),
                 "city": _city,
                 "state": _state,
                 "country": _country,
@@ -55,7 +164,29 @@ class VisPhysicalNode(BaseModel):
         except Exception as e:
             logger.error('Fail when processing line: %s, err: %s, stack: %s', line, e, traceback.format_exc())
             return None
-        
+
+    @classmethod
+    def from_lines(cls, lines):
+        # batch version of from_line, one entry per line and None for the lines that fail
+        keys = ['organization', 'name', "latitude", "longitude", "city", "state", "country", "source", "date"]
+        objs = [None] * len(lines)
+        positions, columns = _split_columns(lines, keys, {
+            'organization': _strip_quote, 'name': _strip_quote, 'latitude': to_float, 'longitude': to_float, 'date': _parse_date})
+        for pos, _organization, _name, _latitude, _longitude, _city, _state, _country, _source, _date in zip(positions, *columns):
+            objs[pos] = {
+                "name": _name,
+                "organization": _organization,
+                "latitude": _latitude,
+                "longitude": _longitude,
+                "location": to_geojson_point(_latitude, _longitude),
+                "city": _city,
+                "state": _state,
+                "country": _country,
+                "source": _source,
+                "date": _date
+            }
+        return objs
+
 
 class VisSubmarineCable(BaseModel):
     index: int
@@ -63,6 +194,10 @@ class VisSubmarineCable(BaseModel):
     name: str
     feature_id: str
     coordinates: list
+    coordinates_high: list
+    coordinates_medium: list
+    coordinates_low: list
+    bbox: dict
     source: str
     date: datetime
 
@@ -85,19 +220,67 @@ class VisSubmarineCable(BaseModel):
                 "name": _name,
                 "feature_id": _feature_id,
                 "coordinates": _coordinates,
+                "bbox": to_bbox(point for line in _coordinates for point in line),
                 "source": _source,
                 "date": _date
             }
+            for lod, tolerance in LOD_TOLERANCES.items():
+                obj[f'coordinates_{lod}'] = [simplify_line(line, tolerance) for line in _coordinates]
             return obj
         except Exception as e:
             logger.error('Fail when processing line: %s, err: %s, stack: %s', line, e, traceback.format_exc())
             return None
+
+    @staticmethod
+    def _geometry(value):
+        wkt = value.strip("\"")
+        assert wkt.startswith("MULTILINESTRING")
+        _coordinates = parse_wkt_multilinestring(wkt)
+        geometry = {"coordinates": _coordinates, "bbox": to_bbox(point for line in _coordinates for point in line)}
+        for lod, tolerance in LOD_TOLERANCES.items():
+            geometry[f'coordinates_{lod}'] = [simplify_line(line, tolerance) for line in _coordinates]
+        return geometry
+
+    @classmethod
+    def from_lines(cls, lines):
+        # batch version of from_line, one entry per line and None for the lines that fail
+        keys = ['id', 'name', 'feature_id', 'coordinates', 'source', 'date']
+        objs = [None] * len(lines)
+        positions, columns = _split_columns(lines, keys, {'date': _parse_date})
+        columns[3] = _line_geometries(lines, positions, columns[3], "MULTILINESTRING", cls._geometry)
+        for pos, _id, _name, _feature_id, _geometry, _source, _date in zip(positions, *columns):
+            if _geometry is None:
+                continue
+            objs[pos] = {
+                "id": _id,
+                "name": _name,
+                "feature_id": _feature_id,
+                "coordinates": _geometry.pop("coordinates"),
+                "bbox": _geometry.pop("bbox"),
+                "source": _source,
+                "date": _date,
+                **_geometry
+            }
+        return objs
         
     @classmethod
     def fill_unknown_fields(cls, obj, idx):
         obj['index'] = idx
         return obj
 
+    @classmethod
+    def pack_coordinates(cls, obj):
+        # stores coordinates as coordinates_bin, see utils.conversion.encode_coordinates
+        if 'coordinates' in obj:
+            obj['coordinates_bin'] = encode_coordinates(obj.pop('coordinates'))
+        return obj
+
+    @classmethod
+    def unpack_coordinates(cls, obj):
+        if 'coordinates_bin' in obj:
+            obj['coordinates'] = lines_to_list(decode_coordinates(obj.pop('coordinates_bin')))
+        return obj
+
     # @classmethod
     # def from_dict(cls, idx, cbl_item, coords_dict):
     #     try:
@@ -127,6 +310,7 @@ class VisLandingPoint(BaseModel):
     active: bool
     latitude: float
     longitude: float
+    location: Optional[dict]
     city: str
     state: str
     country: str
@@ -150,6 +334,7 @@ class VisLandingPoint(BaseModel):
             obj = {
                 "latitude": _latitude,
                 "longitude": _longitude,
+                "location": to_geojson_point(_latitude, _longitude),
                 "city": _city,
                 "state": _state,
                 "country": _country,
@@ -160,6 +345,25 @@ class VisLandingPoint(BaseModel):
         except Exception as e:
             logger.error('Fail when processing line: %s, err: %s, stack: %s', line, e, traceback.format_exc())
             return None
+
+    @classmethod
+    def from_lines(cls, lines):
+        # batch version of from_line, one entry per line and None for the lines that fail
+        keys = ["city_name", "state_province", "country", "latitude", "longitude", "source", "asof_date", "standard_city", "standard_state", "standard_country"]
+        objs = [None] * len(lines)
+        positions, columns = _split_columns(lines, keys, {'latitude': to_float, 'longitude': to_float, 'asof_date': _parse_date})
+        for pos, _, _, _, _latitude, _longitude, _source, _date, _city, _state, _country in zip(positions, *columns):
+            objs[pos] = {
+                "latitude": _latitude,
+                "longitude": _longitude,
+                "location": to_geojson_point(_latitude, _longitude),
+                "city": _city,
+                "state": _state,
+                "country": _country,
+                "source": _source,
+                "date": _date
+            }
+        return objs
         
     @classmethod
     def fill_unknown_fields(cls, obj, idx):
@@ -179,6 +383,10 @@ class VisLandCable(BaseModel):
     to_country: str
     distance: float
     coordinates: list
+    coordinates_high: list
+    coordinates_medium: list
+    coordinates_low: list
+    bbox: dict
     date: datetime
 
     @classmethod
@@ -207,17 +415,68 @@ class VisLandCable(BaseModel):
                 "to_country": _to_country,
                 "distance": _distance,
                 "coordinates": _coordinates,
+                "bbox": to_bbox(_coordinates),
                 "date": _date
             }
+            for lod, tolerance in LOD_TOLERANCES.items():
+                obj[f'coordinates_{lod}'] = simplify_line(_coordinates, tolerance)
             return obj
         except Exception as e:
             logger.error('Fail when processing line: %s, err: %s, stack: %s', line, e, traceback.format_exc())
             return None
+
+    @staticmethod
+    def _geometry(value):
+        wkt = value.strip("\"")
+        assert wkt.startswith("LINESTRING")
+        _coordinates = parse_wkt_linestring(wkt)
+        geometry = {"coordinates": _coordinates, "bbox": to_bbox(_coordinates)}
+        for lod, tolerance in LOD_TOLERANCES.items():
+            geometry[f'coordinates_{lod}'] = simplify_line(_coordinates, tolerance)
+        return geometry
+
+    @classmethod
+    def from_lines(cls, lines):
+        # batch version of from_line, one entry per line and None for the lines that fail
+        keys = ['from_city', 'from_state', 'from_country', 'to_city', 'to_state', 'to_country', 'distance', 'coordinates', 'date']
+        objs = [None] * len(lines)
+        positions, columns = _split_columns(lines, keys, {'distance': to_float, 'date': _parse_date})
+        columns[7] = _line_geometries(lines, positions, columns[7], "LINESTRING", cls._geometry)
+        for pos, _from_city, _from_state, _from_country, _to_city, _to_state, _to_country, _distance, _geometry, _date in zip(positions, *columns):
+            if _geometry is None:
+                continue
+            objs[pos] = {
+                "from_city": _from_city,
+                "from_state": _from_state,
+                "from_country": _from_country,
+                "to_city": _to_city,
+                "to_state": _to_state,
+                "to_country": _to_country,
+                "distance": _distance,
+                "coordinates": _geometry.pop("coordinates"),
+                "bbox": _geometry.pop("bbox"),
+                "date": _date,
+                **_geometry
+            }
+        return objs
         
     @classmethod
     def fill_unknown_fields(cls, obj, idx):
         obj['index'] = idx
         return obj
+
+    @classmethod
+    def pack_coordinates(cls, obj):
+        # stores coordinates as coordinates_bin, see utils.conversion.encode_coordinates
+        if 'coordinates' in obj:
+            obj['coordinates_bin'] = encode_coordinates([obj.pop('coordinates')])
+        return obj
+
+    @classmethod
+    def unpack_coordinates(cls, obj):
+        if 'coordinates_bin' in obj:
+            obj['coordinates'] = lines_to_list(decode_coordinates(obj.pop('coordinates_bin')), multi=False)
+        return obj
     
 
 class VisPop(BaseModel):
@@ -225,6 +484,7 @@ class VisPop(BaseModel):
     asn: int
     latitude: float
     longitude: float
+    location: Optional[dict]
     facility_id: int
     city_id: int
     landing_point_id: int
@@ -249,6 +509,7 @@ class VisPop(BaseModel):
                 "asn": _asn,
                 "latitude": _latitude,
                 "longitude": _longitude,
+                "location": to_geojson_point(_latitude, _longitude),
                 "facility_id": _facility_id,
                 "city_id": _city_id,
                 "landing_point_id": _landing_point_id,
@@ -258,6 +519,28 @@ class VisPop(BaseModel):
         except Exception as e:
             logger.error('Fail when processing line: %s, err: %s, stack: %s', line, e, traceback.format_exc())
             return None
+
+    @classmethod
+    def from_lines(cls, lines):
+        # batch version of from_line, one entry per line and None for the lines that fail
+        keys = ['index', 'asn', 'latitude', 'longitude', 'facility_id', 'city_id', 'landing_point_id', 'distance']
+        objs = [None] * len(lines)
+        positions, columns = _split_columns(lines, keys, {
+            'index': int, 'asn': int, 'latitude': to_float, 'longitude': to_float,
+            'facility_id': int, 'city_id': int, 'landing_point_id': int, 'distance': to_float})
+        for pos, _index, _asn, _latitude, _longitude, _facility_id, _city_id, _landing_point_id, _distance in zip(positions, *columns):
+            objs[pos] = {
+                "index": _index,
+                "asn": _asn,
+                "latitude": _latitude,
+                "longitude": _longitude,
+                "location": to_geojson_point(_latitude, _longitude),
+                "facility_id": _facility_id,
+                "city_id": _city_id,
+                "landing_point_id": _landing_point_id,
+                "distance": _distance
+            }
+        return objs
         
 
 class VisPhysicalLink(BaseModel):
@@ -299,6 +582,27 @@ class VisPhysicalLink(BaseModel):
             logger.error('Fail when processing line: %s, err: %s, stack: %s', line, e, traceback.format_exc())
             return None
 
+    @classmethod
+    def from_lines(cls, lines):
+        # batch version of from_line, one entry per line and None for the lines that fail
+        keys = ['index', 'src_pop_index', 'dst_pop_index', 'src_asn', 'dst_asn', 'ltype', 'cable_ids', 'submarine_ids']
+        objs = [None] * len(lines)
+        positions, columns = _split_columns(lines, keys, {
+            'index': int, 'src_pop_index': _to_index, 'dst_pop_index': _to_index, 'src_asn': int, 'dst_asn': int,
+            'cable_ids': _to_int_list, 'submarine_ids': _to_int_list})
+        for pos, _index, _src_pop_index, _dst_pop_index, _src_asn, _dst_asn, _ltype, _cable_ids, _submarine_ids in zip(positions, *columns):
+            objs[pos] = {
+                "index": _index,
+                "src_pop_index": _src_pop_index,
+                "dst_pop_index": _dst_pop_index,
+                "src_asn": _src_asn,
+                "dst_asn": _dst_asn,
+                "ltype": _ltype,
+                "cable_ids": _cable_ids,
+                "submarine_ids": _submarine_ids
+            }
+        return objs
+
 
 class VisLogicNode(BaseModel):
     index: int
@@ -310,6 +614,7 @@ class VisLogicNode(BaseModel):
     country_code: str
     latitude: float
     longitude: float
+    location: Optional[dict]
     cone_size: int
     cone_prefix_size: int
     degree_provider: int
@@ -325,6 +630,8 @@ class VisLogicNode(BaseModel):
             country_info = asrank.get('country', None)
             country_name = country_info.get('name', '') if country_info else ''
             country_code = country_info.get('iso', '') if country_info else ''
+            _latitude = round(float(asrank['latitude']), KEEP_DIGITS)
+            _longitude = round(float(asrank['longitude']), KEEP_DIGITS)
             res = {
                 "index": idx,
                 "asn": int(asrank['asn']),
@@ -333,8 +640,9 @@ class VisLogicNode(BaseModel):
                 "organization": organization,
                 "country": country_name,
                 "country_code": country_code,
-                "latitude": round(float(asrank['latitude']), KEEP_DIGITS),
-                "longitude": round(float(asrank['longitude']), KEEP_DIGITS),
+                "latitude": _latitude,
+                "longitude": _longitude,
+                "location": to_geojson_point(_latitude, _longitude),
                 "cone_size": int(asrank.get('cone', {}).get('numberAsns', 0)),
                 "cone_prefix_size": int(asrank.get('cone', {}).get('numberPrefixes', 0)),
                 "degree_provider": int(asrank.get('asnDegree', {}).get('provider', 0)),
@@ -359,21 +667,27 @@ class VisLogicLink(BaseModel):
     src_longitude: float
     dst_latitude: float
     dst_longitude: float
+    bbox: dict
     link_type: str
 
     @classmethod
     def to_obj(cls, idx, src_nidx, dst_nidx, link_type, src_asrank, dst_asrank):
         try:
+            _src_latitude = round(float(src_asrank['latitude']), KEEP_DIGITS)
+            _src_longitude = round(float(src_asrank['longitude']), KEEP_DIGITS)
+            _dst_latitude = round(float(dst_asrank['latitude']), KEEP_DIGITS)
+            _dst_longitude = round(float(dst_asrank['longitude']), KEEP_DIGITS)
             obj = {
                 "index": idx,
                 "src_node_index": src_nidx,
                 "dst_node_index": dst_nidx,
                 "src_asn": int(src_asrank['asn']),
                 "dst_asn": int(dst_asrank['asn']),
-                "src_latitude": round(float(src_asrank['latitude']), KEEP_DIGITS),
-                "src_longitude": round(float(src_asrank['longitude']), KEEP_DIGITS),
-                "dst_latitude": round(float(dst_asrank['latitude']), KEEP_DIGITS),
-                "dst_longitude": round(float(dst_asrank['longitude']), KEEP_DIGITS),
+                "src_latitude": _src_latitude,
+                "src_longitude": _src_longitude,
+                "dst_latitude": _dst_latitude,
+                "dst_longitude": _dst_longitude,
+                "bbox": to_bbox([(_src_longitude, _src_latitude), (_dst_longitude, _dst_latitude)]),
                 "link_type": link_type
             }
             return obj
@@ -388,23 +702,44 @@ class VisCity(BaseModel):
     country: str
     latitude: float
     longitude: float
+    location: Optional[dict]
 
     @classmethod
     def from_line(cls, line):
         keys = ['city', 'state', 'country', 'latitude', 'longitude']
         try:
             city_info = dict(zip(keys, split_string(line)))
+            _latitude = round(float(city_info['latitude']), KEEP_DIGITS)
+            _longitude = round(float(city_info['longitude']), KEEP_DIGITS)
             obj = {
                 "city": city_info['city'],
                 "state": city_info['state'],
                 "country": city_info['country'],
-                "latitude": round(float(city_info['latitude']), KEEP_DIGITS),
-                "longitude": round(float(city_info['longitude']), KEEP_DIGITS)
+                "latitude": _latitude,
+                "longitude": _longitude,
+                "location": to_geojson_point(_latitude, _longitude)
             }
             return obj
         except Exception as e:
             logger.error('failed to generate obj for city with %s, err: %s, stack: %s', line, e, traceback.format_exc())
             return None
+
+    @classmethod
+    def from_lines(cls, lines):
+        # batch version of from_line, one entry per line and None for the lines that fail
+        keys = ['city', 'state', 'country', 'latitude', 'longitude']
+        objs = [None] * len(lines)
+        positions, columns = _split_columns(lines, keys, {'latitude': _round_float, 'longitude': _round_float})
+        for pos, _city, _state, _country, _latitude, _longitude in zip(positions, *columns):
+            objs[pos] = {
+                "city": _city,
+                "state": _state,
+                "country": _country,
+                "latitude": _latitude,
+                "longitude": _longitude,
+                "location": to_geojson_point(_latitude, _longitude)
+            }
+        return objs
         
     @classmethod
     def fill_unknown_fields(cls, obj, idx):
@@ -2,7 +2,24 @@ from pydantic import BaseModel, Field
 from fastapi import Query
 
 
-class PhysicalNodeQuery(BaseModel):
+class DetailQuery(BaseModel):
+    stream: str = Field(Query(default='')) # stream: '' (single JSON body) or 'ndjson'
+    after: str = Field(Query(default='')) # after: page token, the next of the previous page (its last index, or rank,index for logic nodes)
+    limit: str = Field(Query(default='')) # limit: page size
+    fields: str = Field(Query(default='')) # fields: comma separated fields to return, defaults to all
+
+class GeoQuery(DetailQuery):
+    bbox: str = Field(Query(default='')) # bbox: min_lon,min_lat,max_lon,max_lat
+    near: str = Field(Query(default='')) # near: lat,lon
+    radius_km: str = Field(Query(default='')) # radius_km: radius around near
+    format: str = Field(Query(default='')) # format: '' (array of objects), 'columnar', 'f32' or 'arrow'
+
+class CableQuery(DetailQuery):
+    lod: str = Field(Query(default='')) # lod: full, high, medium or low
+    zoom: str = Field(Query(default='')) # zoom: web map zoom, picks the lod when lod is not given
+    encoding: str = Field(Query(default='')) # encoding: '' (coordinates arrays) or 'bin' (base64 coordinates_bin)
+
+class PhysicalNodeQuery(GeoQuery):
     idxs: str = Field(Query(default=''))
     nms: str = Field(Query(default='')) # nms: name
     orgs: str = Field(Query(default='')) # orgs: organization
@@ -12,7 +29,7 @@ class PhysicalNodeQuery(BaseModel):
     srs: str = Field(Query(default='')) # srs: source
     # Todo: add date
 
-class SubmarineCableQuery(BaseModel):
+class SubmarineCableQuery(CableQuery):
     idxs: str = Field(Query(default=''))
     ids: str = Field(Query(default=''))
     nms: str = Field(Query(default='')) # nms: name
@@ -20,7 +37,7 @@ class SubmarineCableQuery(BaseModel):
     srs: str = Field(Query(default='')) # srs: source
     # Todo: add date
 
-class LandingPointQuery(BaseModel):
+class LandingPointQuery(GeoQuery):
     idxs: str = Field(Query(default=''))
     cidxs: str = Field(Query(default=''))
     active: str = Field(Query(default=''))
@@ -30,32 +47,32 @@ class LandingPointQuery(BaseModel):
     srs: str = Field(Query(default=''))
     # Todo: add date
 
-class LandCableQuery(BaseModel):
+class LandCableQuery(CableQuery):
     idxs: str = Field(Query(default=''))
     # Todo: add date
 
-class LogicNodeQuery(BaseModel):
+class LogicNodeQuery(GeoQuery):
     idxs: str = Field(Query(default=''))
     asns: str = Field(Query(default=''))
 
-class LogicLinkQuery(BaseModel):
+class LogicLinkQuery(DetailQuery):
     idxs: str = Field(Query(default=''))
     asn: str = Field(Query(default=''))
     asns: str = Field(Query(default=''))
     astuple: str = Field(Query(default=''))
 
-class PoPQuery(BaseModel):
+class PoPQuery(GeoQuery):
     idxs: str = Field(Query(default=''))
     asns: str = Field(Query(default=''))
     fidxs: str = Field(Query(default='')) # facility_id(s)
     cidxs: str = Field(Query(default='')) # city_ids
     lidxs: str = Field(Query(default='')) # landing_point_ids
 
-class PhyLinkQuery(BaseModel):
+class PhyLinkQuery(DetailQuery):
     idxs: str = Field(Query(default=''))
     pidxs: str = Field(Query(default='')) # pop_ids
     asns: str = Field(Query(default='')) # asns: asn
     astuple: str = Field(Query(default=''))
 
-class CityQuery(BaseModel):
+class CityQuery(GeoQuery):
     idxs: str = Field(Query(default=''))
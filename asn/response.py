@@ -0,0 +1,133 @@
+import base64
+import orjson
+import logging
+import traceback
+import numpy as np
+from fastapi.responses import JSONResponse, StreamingResponse
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+
+logger = logging.getLogger('asn.response')
+STREAM_NDJSON = 'ndjson'
+NDJSON_MEDIA_TYPE = 'application/x-ndjson'
+JSON_MEDIA_TYPE = 'application/json'
+BINARY_MEDIA_TYPE = 'application/octet-stream'
+ARROW_MEDIA_TYPE = 'application/vnd.apache.arrow.stream'
+FORMAT_COLUMNAR = 'columnar'
+FORMAT_F32 = 'f32'
+FORMAT_ARROW = 'arrow'
+NUMPY_DTYPES = {float: np.float64, int: np.int64, bool: np.bool_}
+STREAM_BATCH_SIZE = 1000 # documents fetched per cursor round trip and flushed per chunk
+
+
+ORJSON_OPTIONS = orjson.OPT_SERIALIZE_NUMPY
+
+
+def _json_default(obj):
+    # orjson handles datetime and contiguous numpy arrays natively, this is the fallback for the rest
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, bytes):
+        return base64.b64encode(obj).decode('ascii')
+    raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
+
+
+def dump_body(body) -> bytes:
+    return orjson.dumps(body, default=_json_default, option=ORJSON_OPTIONS)
+
+
+class ORJSONResponse(JSONResponse):
+    # default response class of the servloc router, used for the plain dict (error) responses
+    def render(self, content) -> bytes:
+        return dump_body(content)
+
+
+async def iter_ndjson(cursor, batch_size=STREAM_BATCH_SIZE, transform=None, limit=0, next_token=None):
+    # the cursor batch size matches the chunk size, so every round trip to mongo
+    # turns into exactly one chunk on the wire and nothing else is buffered.
+    # A page (next_token given) is read with one extra document, it is not streamed but
+    # tells that there is a next page, whose token is sent in a trailer line
+    chunk = []
+    nb_doc, last_token, _next = 0, None, None
+    try:
+        async for doc in cursor.batch_size(batch_size):
+            if next_token is not None:
+                if nb_doc == limit:
+                    _next = last_token
+                    break
+                last_token = next_token(doc)
+            nb_doc += 1
+            if transform is not None:
+                doc = transform(doc)
+            chunk.append(dump_body(doc))
+            if len(chunk) >= batch_size:
+                yield b'\n'.join(chunk) + b'\n'
+                chunk.clear()
+        if next_token is not None:
+            chunk.append(dump_body({'next': _next, 'status': 'ok', 'message': ''}))
+        if chunk:
+            yield b'\n'.join(chunk) + b'\n'
+    except Exception as e:
+        # headers are already sent, so the error can only be reported in-band
+        logger.error(f'Fail to stream documents, err: {e}, stack: {traceback.format_exc()}')
+        yield dump_body({'status': 'bad', 'message': str(e)}) + b'\n'
+
+
+def stream_response(cursor, stream: str, transform=None, limit=0, next_token=None) -> StreamingResponse:
+    # with next_token the stream is a page of `limit` documents followed by a {"next": ...} trailer
+    if stream != STREAM_NDJSON:
+        raise ValueError(f'unsupported stream format: {stream}')
+    return StreamingResponse(iter_ndjson(cursor, transform=transform, limit=limit, next_token=next_token),
+                             media_type=NDJSON_MEDIA_TYPE)
+
+
+def to_columns(docs, model, fields):
+    # struct of arrays: one numpy array per numeric field, plain lists for the others
+    # and for numeric fields with missing values
+    columns = dict()
+    for field in fields:
+        values = [doc.get(field) for doc in docs]
+        dtype = NUMPY_DTYPES.get(model.model_fields[field].annotation)
+        if dtype is not None and not any(value is None for value in values):
+            columns[field] = np.asarray(values, dtype=dtype)
+        else:
+            columns[field] = values
+    return columns
+
+
+def _arrow_stream(columns, _next):
+    if pa is None:
+        raise ValueError('format=arrow requires pyarrow')
+    table = pa.table(columns)
+    if _next is not None:
+        table = table.replace_schema_metadata({'next': str(_next)})
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def render_points(fmt, docs, model, fields, _next=None):
+    """
+    Encode a point layer as (content, media_type, headers):
+    - columnar: {"data": {"index": [...], "latitude": [...], ...}, "next": ..., "status": "ok"}
+    - f32: little-endian float32 (latitude, longitude) pairs in query order
+    - arrow: Arrow IPC stream, the page token is kept in the schema metadata
+    """
+    headers = {'X-Next': str(_next)} if _next is not None else None
+    if fmt == FORMAT_COLUMNAR:
+        body = {'data': to_columns(docs, model, fields), 'next': _next, 'status': 'ok', 'message': ''}
+        return dump_body(body), JSON_MEDIA_TYPE, None
+    if fmt == FORMAT_F32:
+        if 'latitude' not in fields or 'longitude' not in fields:
+            raise ValueError('format=f32 requires latitude and longitude')
+        coords = np.empty((len(docs), 2), dtype='<f4')
+        coords[:, 0] = [doc['latitude'] for doc in docs]
+        coords[:, 1] = [doc['longitude'] for doc in docs]
+        return coords.tobytes(), BINARY_MEDIA_TYPE, {**(headers or {}), 'X-Count': str(len(docs))}
+    if fmt == FORMAT_ARROW:
+        return _arrow_stream(to_columns(docs, model, fields), _next), ARROW_MEDIA_TYPE, headers
+    raise ValueError(f'unsupported format: {fmt}')
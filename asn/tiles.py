@@ -0,0 +1,158 @@
+import math
+import logging
+from datetime import datetime, timezone
+from pymongo.errors import DuplicateKeyError
+from starlette.concurrency import run_in_threadpool
+from shapely.ops import clip_by_rect
+from shapely.geometry import LineString, MultiLineString
+from database.models import TableSelector
+from utils.conversion import LOD_FULL, zoom_to_lod, decode_coordinates
+from .response import dump_body
+
+
+logger = logging.getLogger('asn.tiles')
+TILE_SIZE = 256 # pixels
+MAX_ZOOM = 18
+TILE_BUFFER = 4 # pixels clipped beyond the tile edge, avoids gaps at tile seams
+TILE_TOLERANCE = 0.5 # pixels, simplification tolerance
+MAX_TILE_FEATURES = 50000 # features rendered per tile, a denser tile is cut and marked as truncated
+TILE_LAYERS = {
+    'submarine-cables': TableSelector.get_submarine_cables_table,
+    'land-cables': TableSelector.get_land_cables_table,
+    'logic-links': TableSelector.get_logic_links_table,
+}
+LOGIC_LINK_PROJECTION = {'_id': 0, 'index': 1, 'src_latitude': 1, 'src_longitude': 1, 'dst_latitude': 1, 'dst_longitude': 1}
+
+
+def check_tile(layer, z, x, y):
+    if layer not in TILE_LAYERS:
+        raise ValueError(f'unknown tile layer: {layer}')
+    if not 0 <= z <= MAX_ZOOM:
+        raise ValueError(f'zoom must be within [0, {MAX_ZOOM}]')
+    if not (0 <= x < 2 ** z and 0 <= y < 2 ** z):
+        raise ValueError(f'tile {z}/{x}/{y} does not exist')
+
+
+def _tile_latitude(z, y):
+    n = math.pi * (1 - 2 * y / 2 ** z)
+    return math.degrees(math.atan(math.sinh(n)))
+
+
+def degree_per_pixel(z):
+    return 360 / (TILE_SIZE * 2 ** z)
+
+
+def tile_bounds(z, x, y, buffer=0):
+    # (west, south, east, north) of a web mercator tile, optionally extended by `buffer` pixels
+    margin = buffer * degree_per_pixel(z)
+    west = 360 * x / 2 ** z - 180 - margin
+    east = 360 * (x + 1) / 2 ** z - 180 + margin
+    north = _tile_latitude(z, y) + margin
+    south = _tile_latitude(z, y + 1) - margin
+    # features touching the poles belong to the top and bottom rows
+    if y == 0:
+        north = 90
+    if y == 2 ** z - 1:
+        south = -90
+    return west, south, east, north
+
+
+def tile_query(z, x, y):
+    west, south, east, north = tile_bounds(z, x, y, TILE_BUFFER)
+    return {
+        'bbox.west': {'$lte': east},
+        'bbox.east': {'$gte': west},
+        'bbox.south': {'$lte': north},
+        'bbox.north': {'$gte': south},
+    }
+
+
+def tile_projection(layer, z):
+    if layer == 'logic-links':
+        return LOGIC_LINK_PROJECTION
+    # low zoom tiles are cut from the precomputed simplified cable geometry
+    lod = zoom_to_lod(z)
+    if lod == LOD_FULL:
+        return {'_id': 0, 'index': 1, 'coordinates': 1, 'coordinates_bin': 1}
+    return {'_id': 0, 'index': 1, 'coordinates': {'$ifNull': [f'$coordinates_{lod}', '$coordinates']}}
+
+
+def _geometry(layer, doc):
+    if 'coordinates_bin' in doc:
+        lines = decode_coordinates(doc['coordinates_bin'])
+        return MultiLineString([line for line in lines if len(line) > 1])
+    if layer == 'submarine-cables':
+        return MultiLineString([line for line in doc['coordinates'] if len(line) > 1])
+    if layer == 'land-cables':
+        return LineString(doc['coordinates'])
+    return LineString([(doc['src_longitude'], doc['src_latitude']), (doc['dst_longitude'], doc['dst_latitude'])])
+
+
+def _lines(geom):
+    if geom.is_empty:
+        return []
+    if geom.geom_type == 'LineString':
+        return [list(geom.coords)]
+    if hasattr(geom, 'geoms'):
+        return [line for part in geom.geoms for line in _lines(part)]
+    return []
+
+
+def render_tile(layer, docs, z, x, y):
+    west, south, east, north = tile_bounds(z, x, y, TILE_BUFFER)
+    tolerance = TILE_TOLERANCE * degree_per_pixel(z)
+    # coordinates are only kept to the precision of a pixel
+    digits = max(0, math.ceil(-math.log10(degree_per_pixel(z)))) + 1
+    data = list()
+    truncated = False
+    for i, doc in enumerate(docs):
+        # the cursor holds one feature more than rendered, it tells that the tile is cut
+        if i == MAX_TILE_FEATURES:
+            truncated = True
+            logger.warning(f'{layer} tile {z}/{x}/{y} has more than {MAX_TILE_FEATURES} features, the ones from index {doc["index"]} on are left out')
+            break
+        try:
+            geom = clip_by_rect(_geometry(layer, doc), west, south, east, north)
+            geom = geom.simplify(tolerance, preserve_topology=False)
+        except Exception as e:
+            logger.error(f'Fail to render {layer} {doc.get("index")} in tile {z}/{x}/{y}, err: {e}')
+            continue
+        lines = [[[round(lon, digits), round(lat, digits)] for lon, lat in line] for line in _lines(geom)]
+        lines = [line for line in lines if len(line) > 1]
+        if lines:
+            data.append({'index': doc['index'], 'coordinates': lines})
+    return {'data': data, 'truncated': truncated, 'status': 'ok', 'message': ''}
+
+
+def _tile_doc(layer, z, x, y, generation, content):
+    return {'layer': layer, 'z': z, 'x': x, 'y': y, 'generation': generation,
+            'content': content, 'created_at': datetime.now(timezone.utc)}
+
+
+async def load_tile(layer, z, x, y, generation) -> bytes:
+    # tiles are rendered once per data generation and kept in mongo for all api workers
+    _tiles = TableSelector.get_tiles_table()
+    cached = await _tiles.find_one({'layer': layer, 'z': z, 'x': x, 'y': y, 'generation': generation})
+    if cached is not None:
+        return cached['content']
+    _table = TILE_LAYERS[layer]()
+    cursor = _table.find(tile_query(z, x, y), tile_projection(layer, z)).sort({'index': 1}).limit(MAX_TILE_FEATURES + 1)
+    docs = [doc async for doc in cursor]
+    # clipping and simplification are cpu bound, keep them off the event loop
+    content = dump_body(await run_in_threadpool(render_tile, layer, docs, z, x, y))
+    try:
+        await _tiles.insert_one(_tile_doc(layer, z, x, y, generation, content))
+    except DuplicateKeyError:
+        # another worker rendered the same tile concurrently
+        pass
+    return content
+
+
+def build_tile(layer, z, x, y, generation, name='default_sync'):
+    _table = TILE_LAYERS[layer](name=name)
+    cursor = _table.find(tile_query(z, x, y), tile_projection(layer, z)).sort({'index': 1}).limit(MAX_TILE_FEATURES + 1)
+    content = dump_body(render_tile(layer, cursor, z, x, y))
+    _tiles = TableSelector.get_tiles_table(name=name)
+    _tiles.replace_one({'layer': layer, 'z': z, 'x': x, 'y': y, 'generation': generation},
+                       _tile_doc(layer, z, x, y, generation, content), upsert=True)
+    return len(content)
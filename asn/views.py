@@ -1,7 +1,27 @@
 import logging
 from fastapi import APIRouter, Depends
+from fastapi.responses import Response
 from database.models import TableSelector
+from database.importer import HASH_FIELD
+from utils.conversion import EARTH_RADIUS, LOD_FULL, LOD_TOLERANCES, bbox_to_polygons, zoom_to_lod
+from .cache import response_cache
+from .response import JSON_MEDIA_TYPE, ORJSONResponse, stream_response, dump_body, render_points
+from .tiles import check_tile, load_tile
+from .models import (
+    VisPhysicalNode,
+    VisSubmarineCable,
+    VisLandingPoint,
+    VisLandCable,
+    VisLogicNode,
+    VisLogicLink,
+    VisPop,
+    VisPhysicalLink,
+    VisCity,
+    ENCODING_BIN
+)
 from .query import (
+    GeoQuery,
+    CableQuery,
     PhysicalNodeQuery, 
     SubmarineCableQuery,
     LandingPointQuery,
@@ -14,10 +34,173 @@ from .query import (
 )
 
 
-router = APIRouter(prefix='/servloc')
+router = APIRouter(prefix='/servloc', default_response_class=ORJSONResponse)
 logger = logging.getLogger('asn.views')
 NB_LOGIC_NODE_SAMPLE = 10000
 NB_LOGIC_LINK_SAMPLE = 10000
+DEFAULT_PAGE_SIZE = 1000
+MAX_PAGE_SIZE = 10000
+LOD_FIELDS = [f'coordinates_{lod}' for lod in LOD_TOLERANCES]
+PROJECTION = {'_id': 0, 'location': 0, 'bbox': 0, HASH_FIELD: 0, **{field: 0 for field in LOD_FIELDS}}
+
+
+def _keyset(sort):
+    # pages follow the sort of the endpoint, index breaks the ties so the keyset is unique
+    keyset = list(sort or ())
+    if 'index' not in keyset:
+        keyset.append('index')
+    return keyset
+
+
+def _paginate(query_params, args, keyset, cap=MAX_PAGE_SIZE):
+    # keyset pagination: the page token holds the keyset values of the last document of
+    # the previous page, so each page is a range scan instead of a skip
+    if args.after:
+        values = [int(value) for value in args.after.split(',')]
+        if len(values) != len(keyset):
+            raise ValueError(f'invalid page token: {args.after}')
+        if len(keyset) == 1:
+            key_params = query_params.setdefault(keyset[0], dict())
+            key_params['$gt'] = values[0]
+        else:
+            # (k1, k2) > (v1, v2) is k1 > v1 or (k1 == v1 and k2 > v2)
+            conditions = [{**dict(zip(keyset[:i], values[:i])), keyset[i]: {'$gt': values[i]}} for i in range(len(keyset))]
+            query_params.setdefault('$and', list()).append({'$or': conditions})
+    limit = int(args.limit) if args.limit else DEFAULT_PAGE_SIZE
+    if limit <= 0:
+        raise ValueError(f'invalid limit: {args.limit}')
+    return min(limit, cap)
+
+
+def _page_token(doc, keyset):
+    # the last index for pages in index order, "<rank>,<index>" for the ones in rank order
+    if len(keyset) == 1:
+        return doc[keyset[0]]
+    return ','.join(str(doc[key]) for key in keyset)
+
+
+def _locate(query_params, args):
+    # viewport (bbox) and radius (near + radius_km) filters, both served by the 2dsphere index on location
+    conditions = list()
+    if args.bbox:
+        min_lon, min_lat, max_lon, max_lat = map(float, args.bbox.split(','))
+        polygons = bbox_to_polygons(min_lon, min_lat, max_lon, max_lat)
+        conditions.append({'$or': [{'location': {'$geoWithin': {'$geometry': polygon}}} for polygon in polygons]})
+    if args.near:
+        if not args.radius_km:
+            raise ValueError('radius_km is required with near')
+        lat, lon = map(float, args.near.split(','))
+        radius = float(args.radius_km) / EARTH_RADIUS
+        conditions.append({'location': {'$geoWithin': {'$centerSphere': [[lon, lat], radius]}}})
+    if conditions:
+        query_params.setdefault('$and', list()).extend(conditions)
+
+
+def _lod(args):
+    if not isinstance(args, CableQuery):
+        return LOD_FULL
+    lod = args.lod or (zoom_to_lod(int(args.zoom)) if args.zoom else LOD_FULL)
+    if lod != LOD_FULL and lod not in LOD_TOLERANCES:
+        raise ValueError(f'unknown lod: {lod}')
+    return lod
+
+
+def _transform(args, model):
+    # cables are stored with coordinates or coordinates_bin, responses carry the encoding the client asked for
+    if not isinstance(args, CableQuery):
+        return None
+    if args.encoding == ENCODING_BIN:
+        return model.pack_coordinates
+    if args.encoding:
+        raise ValueError(f'unknown encoding: {args.encoding}')
+    return model.unpack_coordinates
+
+
+def _fields(args, model, keyset=()):
+    # fields= is checked against the model, internal fields (location, bbox, lod levels) are never returned
+    fields = [field for field in model.model_fields if field not in PROJECTION]
+    if not args.fields:
+        return fields
+    requested = list(dict.fromkeys(field.strip() for field in args.fields.split(',') if field.strip()))
+    unknown = [field for field in requested if field not in fields]
+    if unknown:
+        raise ValueError(f'unknown fields: {",".join(unknown)}, available: {",".join(fields)}')
+    # the page token is read from the keyset fields
+    requested.extend(key for key in keyset if key not in requested)
+    return requested
+
+
+def _projection(args, model, keyset=()):
+    lod = _lod(args)
+    if not args.fields and lod == LOD_FULL:
+        return PROJECTION
+    projection = {field: 1 for field in _fields(args, model, keyset)}
+    projection['_id'] = 0
+    # the simplified geometry is served as coordinates, documents imported
+    # before the levels existed fall back to the full geometry
+    if lod != LOD_FULL and 'coordinates' in projection:
+        projection['coordinates'] = {'$ifNull': [f'$coordinates_{lod}', '$coordinates']}
+    elif 'coordinates' in projection:
+        projection['coordinates_bin'] = 1
+    return projection
+
+
+async def _fetch(cursor, limit, keyset, transform=None):
+    # the cursor of a page holds one extra document, it tells whether there is a next page
+    data = []
+    async for cur in cursor:
+        data.append(cur if transform is None else transform(cur))
+    _next = None
+    if keyset and len(data) > limit:
+        data = data[:limit]
+        _next = _page_token(data[-1], keyset)
+    return data, _next
+
+
+def _render(args, model, data, _next, keyset):
+    paginated = bool(keyset)
+    fmt = getattr(args, 'format', '')
+    if fmt:
+        return render_points(fmt, data, model, _fields(args, model, keyset), _next if paginated else None)
+    body = {'data': data, 'status': 'ok', 'message': ''}
+    if paginated:
+        body = {'data': data, 'next': _next, 'status': 'ok', 'message': ''}
+    return dump_body(body), JSON_MEDIA_TYPE, None
+
+
+async def _respond(_table, query_params, args, model, sort=None, cap=0):
+    if isinstance(args, GeoQuery):
+        _locate(query_params, args)
+    keyset = list()
+    limit = cap
+    if args.after or args.limit:
+        keyset = _keyset(sort)
+        limit = _paginate(query_params, args, keyset, cap or MAX_PAGE_SIZE)
+        sort = {key: 1 for key in keyset}
+    cursor = _table.find(query_params, _projection(args, model, keyset))
+    transform = _transform(args, model)
+    if sort:
+        cursor = cursor.sort(sort)
+    if limit:
+        cursor = cursor.limit(limit + 1 if keyset else limit)
+    if args.stream:
+        if getattr(args, 'format', ''):
+            raise ValueError('format and stream can not be combined')
+        next_token = (lambda doc: _page_token(doc, keyset)) if keyset else None
+        return stream_response(cursor, args.stream, transform, limit, next_token)
+    # the data only changes on import, so identical queries are answered from
+    # the serialized body cached for the current data generation
+    key = response_cache.make_key(args)
+    await response_cache.validate()
+    cached = response_cache.get(key)
+    if cached is None:
+        # another request may move the generation while this one reads the data
+        generation = response_cache.generation
+        data, _next = await _fetch(cursor, limit, keyset, transform)
+        cached = _render(args, model, data, _next, keyset)
+        response_cache.set(key, *cached, generation=generation)
+    content, media_type, headers = cached
+    return Response(content=content, media_type=media_type, headers=headers)
 
 
 @router.get('/physical-nodes/detail')
@@ -35,10 +218,7 @@ async def get_nodes(args: PhysicalNodeQuery = Depends()):
                     query_params[columns[i]] = {'$in': [int(param) for param in params.split(',')]}
                 else:
                     query_params[columns[i]] = {'$in': params.split(',')}
-        data = []
-        async for cur in _table.find(query_params, {'_id': 0}):
-            data.append(cur)
-        return {'data': data, 'status': 'ok', 'message': ''}
+        return await _respond(_table, query_params, args, VisPhysicalNode)
     except Exception as e:
         logger.error(f'Fail to get physical nodes with {args}, err: {e}')
         return {'data': [], 'status': 'bad', 'message': str(e)}
@@ -58,10 +238,7 @@ async def get_submarine_cables(args: SubmarineCableQuery = Depends()):
                     query_params[columns[i]] = {'$in': [int(param) for param in params.split(',')]}
                 else:
                     query_params[columns[i]] = {'$in': params.split(',')}
-        data = []
-        async for cur in _table.find(query_params, {'_id': 0}):
-            data.append(cur)
-        return {'data': data, 'status': 'ok', 'message': ''}
+        return await _respond(_table, query_params, args, VisSubmarineCable)
     except Exception as e:
         logger.error(f'Fail to get submarine cables with {args}, err: {e}')
         return {'data': [], 'status': 'bad', 'message': str(e)}
@@ -81,10 +258,7 @@ async def get_landing_points(args: LandingPointQuery = Depends()):
                     query_params[columns[i]] = params == 'true'
                 else:
                     query_params[columns[i]] = {'$in': params.split(',')}
-        data = []
-        async for cur in _table.find(query_params, {'_id': 0}):
-            data.append(cur)
-        return {'data': data, 'status': 'ok', 'message': ''}
+        return await _respond(_table, query_params, args, VisLandingPoint)
     except Exception as e:
         logger.error(f'Fail to get landing points with {args}, err: {e}')
         return {'data': [], 'status': 'bad', 'message': str(e)}
@@ -97,10 +271,7 @@ async def get_land_cables(args: LandCableQuery = Depends()):
         query_params = dict()
         if args.idxs:
             query_params['index'] = {'$in': [int(idx) for idx in args.idxs.split(',')]}
-        data = []
-        async for cur in _table.find(query_params, {'_id': 0}):
-            data.append(cur)
-        return {'data': data, 'status': 'ok', 'message': ''}
+        return await _respond(_table, query_params, args, VisLandCable)
     except Exception as e:
         logger.error(f'Fail to get land cables with {args}, err: {e}')
         return {'data': [], 'status': 'bad', 'message': str(e)}
@@ -115,10 +286,7 @@ async def get_logic_nodes(args: LogicNodeQuery = Depends()):
             query_params['index'] = {'$in': [int(idx) for idx in args.idxs.split(',')]}
         if args.asns:
             query_params['asn'] = {'$in': [int(asn) for asn in args.asns.split(',')]}
-        data = []
-        async for cur in _table.find(query_params, {'_id': 0}).sort({'rank': 1}).limit(NB_LOGIC_NODE_SAMPLE):
-            data.append(cur)
-        return {'data': data, 'status': 'ok', 'message': ''}
+        return await _respond(_table, query_params, args, VisLogicNode, sort={'rank': 1}, cap=NB_LOGIC_NODE_SAMPLE)
     except Exception as e:
         logger.error(f'failed to get logic_nodes data with {args}, err: {e}')
         return {'data': [], 'status': 'bad', 'message': str(e)}
@@ -139,10 +307,7 @@ async def get_logic_links(args: LogicLinkQuery = Depends()):
         elif args.astuple:
             asn1, asn2 = map(int, args.astuple.strip().split(','))
             query_params['$or'] = [{'src_asn': asn1, 'dst_asn': asn2}, {'src_asn': asn2, 'dst_asn': asn1}]
-        data = []
-        async for cur in _table.find(query_params, {'_id': 0}).limit(NB_LOGIC_LINK_SAMPLE):
-            data.append(cur)
-        return {'data': data, 'status': 'ok', 'message': ''}
+        return await _respond(_table, query_params, args, VisLogicLink, cap=NB_LOGIC_LINK_SAMPLE)
     except Exception as e:
         logger.error(f'failed to get logic_links data with {args}, err: {e}')
         return {'data': [], 'status': 'bad', 'message': str(e)}
@@ -162,10 +327,7 @@ async def get_pop(args: PoPQuery = Depends()):
             query_params['city_id'] = {'$in': [int(cid) for cid in args.cidxs.split(',')]}
         if args.lidxs:
             query_params['landing_point_id'] = {'$in': [int(lid) for lid in args.lidxs.split(',')]}
-        data = []
-        async for cur in _table.find(query_params, {'_id': 0}):
-            data.append(cur)
-        return {'data': data, 'status': 'ok', 'message': ''}
+        return await _respond(_table, query_params, args, VisPop)
     except Exception as e:
         logger.error(f'failed to get pop data, err: {e}')
         return {'data': [], 'status': 'bad', 'message': str(e)}
@@ -184,10 +346,7 @@ async def get_phy_links(args: PhyLinkQuery = Depends()):
         elif args.astuple:
             asn1, asn2 = map(int, args.astuple.strip().split(','))
             query_params['$or'] = [{'src_asn': asn1, 'dst_asn': asn2}, {'src_asn': asn2, 'dst_asn': asn1}]
-        data = []
-        async for cur in _table.find(query_params, {'_id': 0}):
-            data.append(cur)
-        return {'data': data, 'status': 'ok', 'message': ''}
+        return await _respond(_table, query_params, args, VisPhysicalLink)
     except Exception as e:
         logger.error(f'failed to get phy_links data, err: {e}')
         return {'data': [], 'status': 'bad', 'message': str(e)}
@@ -199,10 +358,25 @@ async def get_city(args: CityQuery = Depends()):
         query_params = dict()
         if args.idxs:
             query_params['index'] = {'$in': [int(idx) for idx in args.idxs.split(',')]}
-        data = []
-        async for cur in _table.find(query_params, {'_id': 0}):
-            data.append(cur)
-        return {'data': data, 'status': 'ok', 'message': ''}
+        return await _respond(_table, query_params, args, VisCity)
     except Exception as e:
         logger.error(f'failed to get city data, err: {e}')
         return {'data': [], 'status': 'bad', 'message': str(e)}
+
+
+@router.get('/tiles/{layer}/{z}/{x}/{y}')
+async def get_tile(layer: str, z: int, x: int, y: int):
+    try:
+        check_tile(layer, z, x, y)
+        await response_cache.validate()
+        key = ('tile', layer, z, x, y)
+        cached = response_cache.get(key)
+        if cached is None:
+            generation = response_cache.generation
+            cached = (await load_tile(layer, z, x, y, generation), JSON_MEDIA_TYPE, None)
+            response_cache.set(key, *cached, generation=generation)
+        content, media_type, headers = cached
+        return Response(content=content, media_type=media_type, headers=headers)
+    except Exception as e:
+        logger.error(f'failed to get {layer} tile {z}/{x}/{y}, err: {e}')
+        return {'data': [], 'status': 'bad', 'message': str(e)}
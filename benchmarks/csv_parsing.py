@@ -0,0 +1,116 @@
+"""
+Benchmark of the batch from_lines parsers of asn.models against the per-line from_line path, on generated rows
+that mix 4, 6 and 8 decimal coordinates with a few malformed lines. Run from the repository root:
+
+    python -m benchmarks.csv_parsing
+    python -m benchmarks.csv_parsing --rows 300000 --cable-vertices 200
+"""
+import os
+import gc
+import time
+import random
+import logging
+import argparse
+import tempfile
+from bson import encode
+from asn.models import (
+    VisPhysicalNode,
+    VisSubmarineCable,
+    VisLandingPoint,
+    VisLandCable,
+    VisPop,
+    VisPhysicalLink,
+    VisCity,
+)
+from database.importer import parse_file
+
+
+def _coordinate():
+    return '{:.{}f}'.format(random.uniform(-80, 80), random.choice([4, 6, 8]))
+
+
+def _points(nb_vertex):
+    return ', '.join('{} {}'.format(_coordinate(), _coordinate()) for _ in range(nb_vertex))
+
+
+def generate_lines(nb_row, nb_vertex=3):
+    # cable rows carry whole geometries, so there are 10 times fewer of them
+    c = _coordinate
+    return {
+        VisPhysicalNode: ['"org{}","n,{}",{},{},c,s,CN,src,2024-01-0{}\n'.format(i, i, c(), c(), i % 9 + 1) if i % 997 else 'bad\n'
+                          for i in range(nb_row)],
+        VisPop: ['{},{},{},{},1,2,3,{}\n'.format(i, i, c(), c(), c()) if i % 991 else '{},x,1,1,1,1,1,1\n'.format(i)
+                 for i in range(nb_row)],
+        VisPhysicalLink: ['{},N{},N{},1,2,t,"1,2,3",\n'.format(i, i, i + 1) for i in range(nb_row)],
+        VisCity: ['c{},s,CN,{},{}\n'.format(i, c(), c()) for i in range(nb_row)],
+        VisLandingPoint: ['a,b,c,{},{},src,2024-01-01,C,S,CN\n'.format(c(), c()) for _ in range(nb_row)],
+        VisLandCable: ['a,b,c,d,e,f,{},"LINESTRING ({})",2024-01-01\n'.format(c(), _points(nb_vertex))
+                       for _ in range(nb_row // 10)],
+        VisSubmarineCable: ['i{},n,f,"MULTILINESTRING (({}), ({}))",src,2024-01-01\n'.format(
+                            i, _points(max(2, nb_vertex // 2)), _points(max(2, nb_vertex // 2))) for i in range(nb_row // 10)],
+    }
+
+
+def _same(expected, parsed):
+    # compared as stored: coordinates are tuples per line and lists in batch, both are bson arrays
+    return len(expected) == len(parsed) and all(
+        (a is None and b is None) or (a is not None and b is not None and encode(a) == encode(b))
+        for a, b in zip(expected, parsed))
+
+
+def benchmark_models(nb_row, nb_vertex):
+    # the import engine pauses the cyclic gc while a chunk is parsed, both paths are timed the same way
+    all_same = True
+    for model, lines in generate_lines(nb_row, nb_vertex).items():
+        gc.disable()
+        try:
+            started_at = time.perf_counter()
+            expected = [model.from_line(line) for line in lines]
+            per_line = time.perf_counter() - started_at
+            started_at = time.perf_counter()
+            parsed = model.from_lines(lines)
+            batch = time.perf_counter() - started_at
+        finally:
+            gc.enable()
+        same = _same(expected, parsed)
+        all_same = all_same and same
+        print('{:18} {:7} lines  per-line {:.2f}s  batch {:.2f}s  {:.1f}x  identical={}  failed={}'.format(
+            model.__name__, len(lines), per_line, batch, per_line / batch, same, sum(obj is None for obj in parsed)))
+    return all_same
+
+
+def benchmark_parse_file(nb_row, workers):
+    # end to end through the import engine on a physical nodes csv
+    lines = generate_lines(nb_row)[VisPhysicalNode]
+    with tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False) as f:
+        f.write('organization,name,latitude,longitude,city,state,country,source,date\n')
+        f.writelines(lines)
+    try:
+        started_at = time.perf_counter()
+        nb_per_line = sum(len(objs) for objs in parse_file(f.name, VisPhysicalNode.from_line, workers=workers))
+        per_line = time.perf_counter() - started_at
+        started_at = time.perf_counter()
+        nb_batch = sum(len(objs) for objs in parse_file(f.name, VisPhysicalNode.from_lines, workers=workers, batch=True))
+        batch = time.perf_counter() - started_at
+    finally:
+        os.remove(f.name)
+    print('parse_file {} lines, {} worker(s): per-line {:.2f}s ({} rows)  batch {:.2f}s ({} rows)'.format(
+        nb_row, workers, per_line, nb_per_line, batch, nb_batch))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compare the batch from_lines parsers with the per-line ones.')
+    parser.add_argument('--rows', type=int, default=200000, help='rows per model, a tenth of it for cables')
+    parser.add_argument('--cable-vertices', type=int, default=3, help='vertices per cable geometry')
+    parser.add_argument('--file-rows', type=int, default=300000, help='rows of the parse_file run, 0 to skip it')
+    parser.add_argument('--workers', type=int, default=1, help='parse_file workers')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    # malformed rows are logged one by one, that is not what is measured
+    logging.disable(logging.CRITICAL)
+    random.seed(args.seed)
+    same = benchmark_models(args.rows, args.cable_vertices)
+    if args.file_rows:
+        benchmark_parse_file(args.file_rows, args.workers)
+    raise SystemExit(0 if same else 1)
@@ -0,0 +1,100 @@
+"""
+Equivalence check and benchmark of utils.geometry.cluster_by_distance_dbscan against the callable-metric
+implementation it replaced. Run from the repository root:
+
+    python -m benchmarks.dbscan_clustering
+    python -m benchmarks.dbscan_clustering --sizes 10000 100000 1000000 --reference-max 10000
+"""
+import time
+import argparse
+import numpy as np
+from sklearn.cluster import DBSCAN
+from utils.geometry import cluster_by_distance_dbscan
+
+
+def reference_point_distance(pos1, pos2):
+    # calc_point_distance before the batch haversine kernels
+    radius = np.double(6371)
+    dlat, dlng = np.radians(pos2 - pos1)
+    a = np.sin(dlat / 2) * np.sin(dlat / 2) + np.cos(np.radians(pos1[0])) * np.cos(np.radians(pos2[0])) * np.sin(dlng / 2) * np.sin(dlng / 2)
+    return np.round(radius * 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a)), 4)
+
+
+def reference_cluster_by_distance_dbscan(idx_list, pos_info, min_distance):
+    # cluster_by_distance_dbscan before it used sklearn's compiled haversine metric
+    if len(idx_list) == 0:
+        return []
+    if len(idx_list) == 1:
+        return [idx_list]
+    positions = np.array([pos_info[idx] for idx in idx_list])
+    labels = DBSCAN(eps=min_distance, min_samples=1, metric=reference_point_distance).fit(positions).labels_
+    clusters = {}
+    for idx, label in zip(idx_list, labels):
+        clusters.setdefault(label, []).append(idx)
+    return list(clusters.values())
+
+
+def clumped_points(rng, nb_point, centers=None, spread=0.3):
+    # nodes scattered around cities, [lat, lon] rows
+    if centers is None:
+        centers = np.c_[rng.uniform(-60, 70, nb_point // 50 + 1), rng.uniform(-180, 180, nb_point // 50 + 1)]
+    positions = centers[rng.integers(0, len(centers), nb_point)] + rng.normal(0, spread, (nb_point, 2))
+    positions[:, 0] = np.clip(positions[:, 0], -90, 90)
+    positions[:, 1] = (positions[:, 1] + 180) % 360 - 180
+    return positions
+
+
+def edge_case_points(rng, nb_point):
+    # clumps around the poles and across the antimeridian, where degree based shortcuts break
+    centers = np.array([[89.9, 0], [-89.9, 90], [85, 179.95], [0, -179.99], [-45, 180], [60, -179.9]])
+    return clumped_points(rng, nb_point, centers, spread=0.2)
+
+
+def check_equivalence(nb_set, nb_point, min_distance, seed):
+    rng = np.random.default_rng(seed)
+    nb_mismatch = 0
+    for i in range(nb_set):
+        positions = edge_case_points(rng, nb_point) if i % 3 == 0 else clumped_points(rng, nb_point)
+        pos_info = {idx: pos for idx, pos in enumerate(positions)}
+        idx_list = list(range(nb_point))
+        expected = reference_cluster_by_distance_dbscan(idx_list, pos_info, min_distance)
+        # partition_size below the set size forces the latitude bands
+        for partition_size in (nb_point + 1, nb_point // 10):
+            clusters = cluster_by_distance_dbscan(idx_list, pos_info, min_distance, partition_size=partition_size)
+            if clusters != expected:
+                nb_mismatch += 1
+                print('set {}: {} clusters, {} expected, partition_size={}'.format(i, len(clusters), len(expected), partition_size))
+    print('{} sets of {} points, {} mismatches'.format(nb_set, nb_point, nb_mismatch))
+    return nb_mismatch == 0
+
+
+def benchmark(sizes, reference_max, min_distance, seed):
+    rng = np.random.default_rng(seed)
+    for nb_point in sizes:
+        positions = clumped_points(rng, nb_point)
+        pos_info = {idx: pos for idx, pos in enumerate(positions)}
+        idx_list = list(range(nb_point))
+        timings = []
+        if nb_point <= reference_max:
+            started_at = time.perf_counter()
+            reference_cluster_by_distance_dbscan(idx_list, pos_info, min_distance)
+            timings.append('reference {:.2f}s'.format(time.perf_counter() - started_at))
+        started_at = time.perf_counter()
+        clusters = cluster_by_distance_dbscan(idx_list, pos_info, min_distance)
+        timings.append('cluster_by_distance_dbscan {:.3f}s'.format(time.perf_counter() - started_at))
+        print('{} points, {} clusters: {}'.format(nb_point, len(clusters), ', '.join(timings)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compare cluster_by_distance_dbscan with the callable-metric version.')
+    parser.add_argument('--sets', type=int, default=30, help='random point sets of the equivalence check')
+    parser.add_argument('--set-size', type=int, default=1000)
+    parser.add_argument('--sizes', type=int, nargs='*', default=[10000, 100000, 1000000], help='benchmarked point counts')
+    parser.add_argument('--reference-max', type=int, default=10000, help='largest point count timed with the reference')
+    parser.add_argument('--min-distance', type=float, default=20, help='km')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    same = check_equivalence(args.sets, args.set_size, args.min_distance, args.seed)
+    benchmark(args.sizes, args.reference_max, args.min_distance, args.seed)
+    raise SystemExit(0 if same else 1)
@@ -24,6 +24,13 @@ class DevSettings(BaseSettings):
             ASYNC=False,
         ),
     )
+    RESPONSE_CACHE_MAX_ENTRIES: int = 1024
+    RESPONSE_CACHE_MAX_BYTES: int = 256 * 1024 * 1024
+    RESPONSE_CACHE_TTL: float = 3600 # seconds
+    RESPONSE_CACHE_CHECK_INTERVAL: float = 5 # seconds between two generation lookups
+    IMPORT_WORKERS: int = 0 # parser processes of the import commands, 0 means one per cpu
+    IMPORT_CHUNK_BYTES: int = 8 * 1024 * 1024 # bytes of input handed to a parser process at once
+    IMPORT_BATCH_BYTES: int = 8 * 1024 * 1024 # bson bytes per insert_many
     LOG_PATH: str = "./log.txt"
     LOG_LEVEL: int = logging.DEBUG
     LOG_FORMAT: str = "[%(asctime)s - %(name)s - %(lineno)d] %(levelname)s: %(message)s"
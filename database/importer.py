@@ -0,0 +1,241 @@
+import gc
+import io
+import os
+import struct
+import hashlib
+import time
+import queue
+import logging
+import threading
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from bson import encode
+from bson.raw_bson import RawBSONDocument
+from pymongo import DeleteMany, ReplaceOne
+from pymongo.errors import BulkWriteError
+from config import Config
+
+
+logger = logging.getLogger('database.importer')
+HASH_FIELD = 'content_hash'
+DELETE_STEP = 10000 # indexes per DeleteMany
+
+
+def _line_ranges(file, skip, chunk_bytes):
+    # split the file after its `skip` header lines into byte ranges ending on a line boundary
+    ranges = list()
+    size = os.path.getsize(file)
+    with open(file, 'rb') as fp:
+        for _ in range(skip):
+            fp.readline()
+        start = fp.tell()
+        while start < size:
+            fp.seek(min(start + chunk_bytes, size))
+            fp.readline()
+            end = min(fp.tell(), size)
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+
+def _parse_range(parser, file, start, end, batch):
+    with open(file, 'rb') as fp:
+        fp.seek(start)
+        data = fp.read(end - start)
+    # same newline handling as iterating over the file opened in text mode
+    lines = io.StringIO(data.decode(), newline=None).readlines()
+    # parsed documents hold no reference cycles, without pausing the cyclic gc it rescans the growing chunk
+    # over and over, which costs as much as the parsing itself
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        if batch:
+            return parser(lines)
+        return [parser(line) for line in lines]
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+
+def parse_file(file, parser, skip=1, workers=None, chunk_bytes=None, batch=False):
+    """
+    Parse the lines of `file` with `parser` in a process pool and yield the results chunk by chunk, in file order.
+    Every line yields one entry, so a line that fails to parse is kept as whatever `parser` returned (usually None).
+    `parser` must be picklable, e.g. a module level function or a classmethod like VisPhysicalNode.from_line.
+    With `batch`, `parser` takes the list of lines of a chunk instead, like VisPhysicalNode.from_lines.
+    """
+    workers = workers or Config.IMPORT_WORKERS or os.cpu_count()
+    ranges = _line_ranges(file, skip, chunk_bytes or Config.IMPORT_CHUNK_BYTES)
+    if workers == 1:
+        # a single worker would only add the cost of pickling every parsed document back
+        for start, end in ranges:
+            yield _parse_range(parser, file, start, end, batch)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # only a few chunks are parsed ahead so memory stays bounded when writing is the bottleneck
+        pending = list()
+        for start, end in ranges:
+            pending.append(executor.submit(_parse_range, parser, file, start, end, batch))
+            if len(pending) > 2 * workers:
+                yield pending.pop(0).result()
+        for future in pending:
+            yield future.result()
+
+
+def content_hash(doc):
+    # parsers build their documents with a fixed key order, so the bson bytes are a stable fingerprint
+    doc = {k: v for k, v in doc.items() if k not in ('_id', HASH_FIELD)}
+    return hashlib.blake2b(encode(doc), digest_size=16).hexdigest()
+
+
+def _with_hash(data):
+    # append the content hash of an encoded document as its last string element, see content_hash
+    value = hashlib.blake2b(data, digest_size=16).hexdigest().encode() + b'\x00'
+    element = b'\x02' + HASH_FIELD.encode() + b'\x00' + struct.pack('<i', len(value)) + value
+    return RawBSONDocument(struct.pack('<i', len(data) + len(element)) + data[4:-1] + element + b'\x00')
+
+
+class BulkWriter:
+    """
+    Write documents with unordered insert_many batches of about `batch_bytes` BSON bytes from a background thread,
+    so that parsing the next chunk overlaps with the round trip of the previous one.
+
+        with BulkWriter(_table) as writer:
+            for objs in parse_file(file, VisPop.from_lines, batch=True):
+                writer.write(objs)
+        nb_inserted = writer.nb_inserted
+    """
+
+    def __init__(self, _table, batch_bytes=None, queue_size=8):
+        self._table = _table
+        self.batch_bytes = batch_bytes or Config.IMPORT_BATCH_BYTES
+        self.nb_submitted = 0
+        self.nb_inserted = 0
+        self.__queue = queue.Queue(maxsize=queue_size)
+        self.__thread = threading.Thread(target=self.__run, name=f'bulk-writer-{_table.name}', daemon=True)
+        self.__started_at = 0.0
+
+    def __enter__(self):
+        self.__started_at = time.monotonic()
+        self.__thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.__queue.put(None)
+        self.__thread.join()
+        elapsed = time.monotonic() - self.__started_at
+        logger.info(f"{self._table.name}: {self.nb_inserted} documents written in {elapsed:.1f}s, "
+                    f"{self.nb_inserted / max(elapsed, 1e-6):.0f} rows/s")
+        return False
+
+    def write(self, _ops):
+        _ops = [_op for _op in _ops if _op is not None]
+        self.nb_submitted += len(_ops)
+        if _ops:
+            self.__queue.put(_ops)
+
+    def __run(self):
+        batch = list()
+        nb_bytes = 0
+        while True:
+            _ops = self.__queue.get()
+            if _ops is None:
+                break
+            for _op in _ops:
+                # documents are encoded once, the size drives the batching and pymongo sends the raw bytes as is,
+                # the content hash lets a later incremental import skip unchanged documents
+                try:
+                    raw = _with_hash(encode(_op))
+                except Exception as e:
+                    logger.error(f"Failed to encode document for {self._table.name}, err: {e}")
+                    continue
+                batch.append(raw)
+                nb_bytes += len(raw.raw)
+                if nb_bytes >= self.batch_bytes:
+                    self.__flush(batch)
+                    batch = list()
+                    nb_bytes = 0
+        if batch:
+            self.__flush(batch)
+
+    def __flush(self, batch):
+        try:
+            self._table.insert_many(batch, ordered=False)
+            self.nb_inserted += len(batch)
+        except BulkWriteError as e:
+            self.nb_inserted += e.details.get('nInserted', 0)
+            logger.error(f"Failed to insert {len(e.details.get('writeErrors', []))} of {len(batch)} documents into "
+                         f"{self._table.name}, first err: {e.details.get('writeErrors', [{}])[0].get('errmsg')}")
+        except Exception as e:
+            logger.error(f"Failed to bulk write for {self._table.name} with len={len(batch)},"
+                         f" err: {e}, stack: {traceback.format_exc()}")
+
+
+class DeltaWriter:
+    """
+    Same interface as BulkWriter, but applies the documents to the live collection as a diff keyed by `index`:
+    documents whose content hash changed are replaced (or inserted), indexes that were not written again are deleted
+    when the writer is closed. Nothing is sent for unchanged documents.
+    """
+
+    def __init__(self, _table, batch_size=1000):
+        self._table = _table
+        self.batch_size = batch_size
+        self.nb_submitted = 0
+        self.nb_upserted = 0
+        self.nb_deleted = 0
+        self.__stored = dict()
+        self.__ops = list()
+        self.__started_at = 0.0
+
+    @property
+    def nb_inserted(self):
+        # documents actually written, as reported by the import commands
+        return self.nb_upserted
+
+    @property
+    def nb_changed(self):
+        return self.nb_upserted + self.nb_deleted
+
+    def __enter__(self):
+        self.__started_at = time.monotonic()
+        self.__stored = {doc['index']: doc.get(HASH_FIELD)
+                         for doc in self._table.find({}, {'_id': 0, 'index': 1, HASH_FIELD: 1})}
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            # whatever was stored and not written again is gone from the input
+            stale = list(self.__stored)
+            for i in range(0, len(stale), DELETE_STEP):
+                self.__ops.append(DeleteMany({'index': {'$in': stale[i:i + DELETE_STEP]}}))
+            self.__flush()
+        elapsed = time.monotonic() - self.__started_at
+        logger.info(f"{self._table.name}: {self.nb_submitted} documents compared in {elapsed:.1f}s, "
+                    f"{self.nb_upserted} upserted, {self.nb_deleted} deleted")
+        return False
+
+    def write(self, _ops):
+        for _op in _ops:
+            if _op is None:
+                continue
+            self.nb_submitted += 1
+            _hash = content_hash(_op)
+            if self.__stored.pop(_op['index'], None) == _hash:
+                continue
+            _op[HASH_FIELD] = _hash
+            self.__ops.append(ReplaceOne({'index': _op['index']}, _op, upsert=True))
+            if len(self.__ops) >= self.batch_size:
+                self.__flush()
+
+    def __flush(self):
+        if not self.__ops:
+            return
+        try:
+            res = self._table.bulk_write(self.__ops, ordered=False)
+            self.nb_upserted += res.upserted_count + res.modified_count
+            self.nb_deleted += res.deleted_count
+        except Exception as e:
+            logger.error(f"Failed to bulk write for {self._table.name} with len={len(self.__ops)},"
+                         f" err: {e}, stack: {traceback.format_exc()}")
+        self.__ops = list()
@@ -0,0 +1,180 @@
+import logging
+import traceback
+from pymongo import ASCENDING, GEOSPHERE, IndexModel
+
+
+logger = logging.getLogger('database.indexes')
+TILE_EXPIRE_SECONDS = 3600 # superseded tiles are kept this long for the api workers that did not see the new generation yet
+
+
+def _unique_index():
+    return IndexModel([('index', ASCENDING)], unique=True)
+
+
+def _geo_index():
+    return IndexModel([('location', GEOSPHERE)])
+
+
+def _bbox_index():
+    # tiles select features whose bounding box overlaps the tile
+    return IndexModel([('bbox.west', ASCENDING), ('bbox.east', ASCENDING), ('bbox.south', ASCENDING), ('bbox.north', ASCENDING)])
+
+
+def _paged(*keys):
+    # (key, index) serves the filter on key alone and, sorted on index, the pages of the filtered query
+    return [IndexModel([(key, ASCENDING), ('index', ASCENDING)]) for key in keys]
+
+
+def _compound(*keys):
+    return IndexModel([(key, ASCENDING) for key in keys])
+
+
+# indexes per collection, derived from the filters and sorts used in asn/views.py
+INDEXES = {
+    'vis_physical_nodes_table': [
+        _unique_index(),
+        _geo_index(),
+        *_paged('name', 'organization', 'city', 'state', 'country', 'source'),
+    ],
+    'vis_submarine_cables_table': [
+        _unique_index(),
+        _bbox_index(),
+        *_paged('id', 'name', 'feature_id', 'source'),
+    ],
+    'vis_landing_points_table': [
+        _unique_index(),
+        _geo_index(),
+        *_paged('cable_id', 'city', 'state', 'country', 'source'),
+    ],
+    'vis_land_cables_table': [
+        _unique_index(),
+        _bbox_index(),
+    ],
+    'vis_logic_nodes_table': [
+        _unique_index(),
+        _geo_index(),
+        # logic nodes are returned in rank order, pages are keyed on (rank, index)
+        _compound('rank', 'index'),
+        _compound('asn', 'rank', 'index'),
+    ],
+    'vis_logic_links_table': [
+        _unique_index(),
+        _bbox_index(),
+        # each branch of the $or on src_asn/dst_asn (and of the as tuple) gets its own prefix,
+        # followed by index for the pages
+        *_paged('src_asn', 'dst_asn'),
+        _compound('src_asn', 'dst_asn', 'index'),
+        _compound('dst_asn', 'src_asn', 'index'),
+    ],
+    'vis_pop_table': [
+        _unique_index(),
+        _geo_index(),
+        *_paged('asn', 'facility_id', 'city_id', 'landing_point_id'),
+    ],
+    'vis_phy_links_table': [
+        _unique_index(),
+        *_paged('src_pop_index', 'dst_pop_index', 'src_asn', 'dst_asn'),
+        _compound('src_asn', 'dst_asn', 'index'),
+        _compound('dst_asn', 'src_asn', 'index'),
+    ],
+    'vis_city_table': [
+        _unique_index(),
+        _geo_index(),
+    ],
+    'vis_tiles_table': [
+        IndexModel([('layer', ASCENDING), ('z', ASCENDING), ('x', ASCENDING), ('y', ASCENDING), ('generation', ASCENDING)], unique=True),
+        # superseded_at is only set once a newer generation is published (see database.services._bump_generation),
+        # tiles of the current generation never expire
+        IndexModel([('superseded_at', ASCENDING)], expireAfterSeconds=TILE_EXPIRE_SECONDS),
+    ],
+    'vis_metadata_table': [
+        IndexModel([('key', ASCENDING)], unique=True),
+    ],
+}
+
+# indexes replaced in INDEXES, dropped by ensure_indexes where they still exist
+DROPPED_INDEXES = {
+    'vis_tiles_table': ['created_at_1'], # expired tiles of the current generation
+}
+
+# representative queries of asn/views.py, as (filter, sort), used to explain index usage
+EXPLAIN_QUERIES = {
+    'vis_physical_nodes_table': [({'index': {'$in': [0]}}, None), ({'country': {'$in': ['']}}, None)],
+    'vis_submarine_cables_table': [({'index': {'$in': [0]}}, None), ({'feature_id': {'$in': ['']}}, None)],
+    'vis_landing_points_table': [({'index': {'$in': [0]}}, None), ({'city': {'$in': ['']}}, None)],
+    'vis_land_cables_table': [({'index': {'$in': [0]}}, None)],
+    'vis_logic_nodes_table': [({}, {'rank': 1}), ({'asn': {'$in': [0]}}, {'rank': 1}),
+                              ({'$or': [{'rank': {'$gt': 0}}, {'rank': 0, 'index': {'$gt': 0}}]}, {'rank': 1, 'index': 1})],
+    'vis_logic_links_table': [({'$or': [{'src_asn': 0}, {'dst_asn': 0}]}, None),
+                              ({'$and': [{'src_asn': {'$in': [0]}}, {'dst_asn': {'$in': [0]}}]}, None),
+                              ({'$or': [{'src_asn': 0}, {'dst_asn': 0}], 'index': {'$gt': 0}}, {'index': 1})],
+    'vis_pop_table': [({'asn': {'$in': [0]}}, None), ({'city_id': {'$in': [0]}}, None)],
+    'vis_phy_links_table': [({'$or': [{'src_pop_index': {'$in': [0]}}, {'dst_pop_index': {'$in': [0]}}]}, None),
+                            ({'$or': [{'src_asn': {'$in': [0]}}, {'dst_asn': {'$in': [0]}}]}, None),
+                            ({'$or': [{'src_asn': {'$in': [0]}}, {'dst_asn': {'$in': [0]}}], 'index': {'$gt': 0}}, {'index': 1})],
+    'vis_city_table': [({'index': {'$in': [0]}}, None)],
+}
+
+
+def ensure_indexes(_table, collection_name=None):
+    # collection_name is the registry entry to apply, it defaults to the collection's own name
+    indexes = INDEXES.get(collection_name or _table.name)
+    if not indexes:
+        return []
+    try:
+        existing = _table.index_information()
+        for name in DROPPED_INDEXES.get(collection_name or _table.name, []):
+            if name in existing:
+                _table.drop_index(name)
+        return _table.create_indexes(indexes)
+    except Exception as e:
+        logger.error(f"Failed to create indexes for {_table.name}, err: {e}, stack: {traceback.format_exc()}")
+        return []
+
+
+async def ensure_indexes_async(_table, collection_name=None):
+    indexes = INDEXES.get(collection_name or _table.name)
+    if not indexes:
+        return []
+    try:
+        existing = await _table.index_information()
+        for name in DROPPED_INDEXES.get(collection_name or _table.name, []):
+            if name in existing:
+                await _table.drop_index(name)
+        return await _table.create_indexes(indexes)
+    except Exception as e:
+        logger.error(f"Failed to create indexes for {_table.name}, err: {e}, stack: {traceback.format_exc()}")
+        return []
+
+
+def _plan_stages(plan):
+    # flatten the winning plan tree into its stage names, e.g. ['FETCH', 'IXSCAN']
+    stages = []
+    while plan:
+        stages.append(plan.get('stage', '?'))
+        if 'inputStages' in plan:
+            for sub_plan in plan['inputStages']:
+                stages.extend(_plan_stages(sub_plan))
+            break
+        plan = plan.get('inputStage')
+    return stages
+
+
+def explain_query(_table, query_params, sort=None):
+    cursor = _table.find(query_params, {'_id': 0})
+    if sort:
+        cursor = cursor.sort(list(sort.items()))
+    explanation = cursor.explain()
+    winning_plan = explanation['queryPlanner']['winningPlan']
+    winning_plan = winning_plan.get('queryPlan', winning_plan)
+    stats = explanation.get('executionStats', {})
+    return {
+        'stages': _plan_stages(winning_plan),
+        'keys_examined': stats.get('totalKeysExamined'),
+        'docs_examined': stats.get('totalDocsExamined'),
+        'returned': stats.get('nReturned'),
+    }
+
+
+def index_stats(_table):
+    return list(_table.aggregate([{'$indexStats': {}}]))
@@ -6,6 +6,11 @@ class TableSelector:
     class Meta:
         db_driver = mongo
 
+    @classmethod
+    def get_table(cls, collection_name, name='default'):
+        db = getattr(cls.Meta.db_driver, name)
+        return db.vis[collection_name]
+
     @classmethod
     def get_physical_nodes_table(cls, name='default'):
         db = getattr(cls.Meta.db_driver, name)
@@ -55,3 +60,13 @@ class TableSelector:
     def get_city_table(cls, name='default'):
         db = getattr(cls.Meta.db_driver, name)
         return db.vis.vis_city_table
+    
+    @classmethod
+    def get_metadata_table(cls, name='default'):
+        db = getattr(cls.Meta.db_driver, name)
+        return db.vis.vis_metadata_table
+    
+    @classmethod
+    def get_tiles_table(cls, name='default'):
+        db = getattr(cls.Meta.db_driver, name)
+        return db.vis.vis_tiles_table
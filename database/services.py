@@ -1,8 +1,15 @@
+import time
 import traceback
 import logging
+from datetime import datetime, timezone
+from pymongo import ReturnDocument
+from .indexes import ensure_indexes
 
 
 logger = logging.getLogger('database.services')
+STAGING_SUFFIX = '__staging_'
+PREVIOUS_SUFFIX = '__previous'
+ROLLBACK_SUFFIX = '__rollback'
 
 
 def _bulk_write(_table, _ops):
@@ -20,3 +27,69 @@ def _bulk_write(_table, _ops):
                      f" err: {e}, stack: {traceback.format_exc()}")
         return 0
     return nb_inserted
+
+
+def _bump_generation(_table):
+    # the api caches responses per data generation, bumping it after an import
+    # makes every worker drop its cached responses on the next lookup
+    res = _table.find_one_and_update(
+        {'key': 'generation'}, {'$inc': {'value': 1}}, upsert=True, return_document=ReturnDocument.AFTER)
+    logger.info(f"Bumped data generation to {res['value']}")
+    # the tiles of older generations are never read again, the ttl index on superseded_at removes them
+    _tiles = _table.database.vis_tiles_table
+    res_tiles = _tiles.update_many({'generation': {'$lt': res['value']}, 'superseded_at': {'$exists': False}},
+                                   {'$set': {'superseded_at': datetime.now(timezone.utc)}})
+    logger.info(f"Marked {res_tiles.modified_count} tiles of older generations as superseded")
+    return res['value']
+
+
+def _get_generation(_table):
+    doc = _table.find_one({'key': 'generation'}, {'_id': 0, 'value': 1})
+    return doc['value'] if doc else 0
+
+
+def _staging_table(_table):
+    # imports are written next to the live collection and swapped in once complete
+    return _table.database[f"{_table.name}{STAGING_SUFFIX}{int(time.time())}"]
+
+
+def _prepare_staging(_staging, _table, expected):
+    ensure_indexes(_staging, _table.name)
+    nb_doc = _staging.count_documents({})
+    if nb_doc == 0 or nb_doc != expected:
+        logger.error(f"Refuse to publish {_staging.name}: {nb_doc} documents, {expected} expected, {_table.name} is kept")
+        return False
+    return True
+
+
+def _swap_collection(_staging, _table):
+    # the live collection is renamed aside (kept for rollback), then the staging one takes its name. both are
+    # catalog operations whatever the size of the data. readers between the two renames find no documents, what
+    # the api caches then is dropped with the generation bump that follows the swap (see asn.cache)
+    previous_name = f"{_table.name}{PREVIOUS_SUFFIX}"
+    if _table.name in _table.database.list_collection_names(filter={'name': _table.name}):
+        _table.rename(previous_name, dropTarget=True)
+    _staging.rename(_table.name, dropTarget=True)
+    logger.info(f"Published {_staging.name} as {_table.name}, previous data kept in {previous_name}")
+
+
+def _rollback_collection(_table):
+    # swap the live and previous collections by renames, running it twice restores the latest import
+    previous_name = f"{_table.name}{PREVIOUS_SUFFIX}"
+    if previous_name not in _table.database.list_collection_names(filter={'name': previous_name}):
+        logger.error(f"No previous data for {_table.name}, nothing to roll back")
+        return False
+    rollback_name = f"{_table.name}{ROLLBACK_SUFFIX}"
+    _table.rename(rollback_name, dropTarget=True)
+    _table.database[previous_name].rename(_table.name)
+    _table.database[rollback_name].rename(previous_name)
+    logger.info(f"Rolled back {_table.name} to {previous_name}")
+    return True
+
+
+def _drop_stagings(*imports):
+    # (written collection, live collection) pairs, incremental imports write the live collection and keep it
+    for _staging, _table in imports:
+        if _staging is not _table:
+            _staging.drop()
+            logger.info(f"Dropped {_staging.name}, {_table.name} is kept")
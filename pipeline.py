@@ -0,0 +1,230 @@
+import os
+import json
+import time
+import hashlib
+import argparse
+import resource
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+
+FINGERPRINT_MTIME = 'mtime'
+FINGERPRINT_HASH = 'hash'
+STATE_FNAME = '.pipeline_state.json'
+HASH_CHUNK_BYTES = 1 << 20
+EXECUTION_KWARGS = ('workers',) # parameters that do not change the outputs of a step
+
+# a step calls preprocess_data.<func>(*args, **kwargs), reads `inputs` and writes `outputs`,
+# a step depends on the steps that write its inputs
+Step = namedtuple('Step', ['name', 'func', 'args', 'inputs', 'outputs', 'kwargs'])
+
+
+def build_steps(itdk_base_dir, igdb_dir, servloc_dir, workers=1):
+    # same files as the calls listed in the __main__ block of preprocess_data.py
+    itdk_tmp_dir = itdk_base_dir.replace('Base', 'Tmp')
+    itdk_target_dir = itdk_base_dir.replace('Base', 'Target')
+    base, tmp, target = [lambda fname, d=d: os.path.join(d, fname) for d in (itdk_base_dir, itdk_tmp_dir, itdk_target_dir)]
+    igdb, servloc = [lambda fname, d=d: os.path.join(d, fname) for d in (igdb_dir, servloc_dir)]
+
+    city_fpath = igdb('city_points/city_points.csv')
+    facility_fpath = igdb('phys_nodes/phy_nodes.csv')
+    complete_facility_fpath = igdb('phys_nodes/phy_nodes_complete.csv')
+    landcable_fpath = igdb('standard_paths/InternetAtlas_standard_paths.csv')
+    simplified_landcable_fpath = igdb('standard_paths/simplified_InternetAtlas_standard_paths.csv')
+    landing_points_fpath = servloc('landing_point_geo.json')
+    submarine_cable_fpath = servloc('submarine_cables.json')
+    cable_geo_fpath = servloc('cable_geo.json')
+    node_facility_fpath = target('nodes.Facility')
+    node_city_fpath = target('nodes.City')
+    node_landing_pts_fpath = target('nodes.landing_points')
+
+    def step(name, args, outputs, inputs=None, **kwargs):
+        # the args are the inputs unless told otherwise
+        return Step(name, name, args, args if inputs is None else inputs, outputs, kwargs)
+
+    return [
+        step('extract_interdomain_links', [base('nodes.as'), base('nodes.geo'), base('links')],
+             [tmp('nodes.as'), tmp('nodes.geo'), tmp('links')]),
+        step('group_proximity_nodes', [tmp('nodes.as'), tmp('nodes.geo'), tmp('links')],
+             [target('nodes.as'), target('nodes.geo'), target('links')], workers=workers),
+        step('remove_redundant_links', [target('links'), target('nodes.as')], [target('unique_links')]),
+        step('complete_phynode_city_info', [city_fpath, facility_fpath], [complete_facility_fpath]),
+        step('simplify_line_string', [landcable_fpath, city_fpath], [simplified_landcable_fpath]),
+        # one step for the three mappings, nodes.geo is read once for all of them
+        step('map_pop_to_locations',
+             [target('nodes.geo'), complete_facility_fpath, city_fpath, landing_points_fpath,
+              node_facility_fpath, node_city_fpath, node_landing_pts_fpath],
+             [node_facility_fpath, node_city_fpath, node_landing_pts_fpath],
+             inputs=[target('nodes.geo'), complete_facility_fpath, city_fpath, landing_points_fpath]),
+        step('map_link2cable',
+             [target('unique_links'), target('nodes.as'), node_city_fpath, city_fpath, simplified_landcable_fpath,
+              submarine_cable_fpath, landing_points_fpath, cable_geo_fpath, target('unique_links_cable.csv')],
+             [target('unique_links_cable.csv')],
+             inputs=[target('unique_links'), target('nodes.as'), node_city_fpath, city_fpath, simplified_landcable_fpath,
+                     submarine_cable_fpath, landing_points_fpath, cable_geo_fpath], workers=workers),
+        step('generate_pop_file',
+             [target('nodes.as'), target('nodes.geo'), node_facility_fpath, node_city_fpath, node_landing_pts_fpath,
+              target('pop.csv')],
+             [target('pop.csv')],
+             inputs=[target('nodes.as'), target('nodes.geo'), node_facility_fpath, node_city_fpath, node_landing_pts_fpath]),
+    ]
+
+
+def file_fingerprint(fpath, mode=FINGERPRINT_MTIME):
+    if not os.path.exists(fpath):
+        return None
+    if mode == FINGERPRINT_HASH:
+        digest = hashlib.blake2b(digest_size=16)
+        with open(fpath, 'rb') as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_BYTES), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+    stat = os.stat(fpath)
+    return '{}-{}'.format(stat.st_size, stat.st_mtime_ns)
+
+
+def step_key(step, mode):
+    # changes whenever an input or a parameter of the step changes
+    kwargs = {k: v for k, v in step.kwargs.items() if k not in EXECUTION_KWARGS}
+    content = json.dumps([step.func, step.args, kwargs, [file_fingerprint(fpath, mode) for fpath in step.inputs]])
+    return hashlib.blake2b(content.encode(), digest_size=16).hexdigest()
+
+
+def is_up_to_date(step, record, key, mode):
+    # the outputs must also be the ones written by the recorded run
+    if record is None or record.get('key') != key:
+        return False
+    return all(record['outputs'].get(fpath) == file_fingerprint(fpath, mode) for fpath in step.outputs)
+
+
+def _run_step(step):
+    # runs in a fresh worker process, so the peak rss is the one of the step alone. steps with workers run
+    # their own process pool, the largest of those processes counts too
+    import preprocess_data
+    started_at = time.monotonic()
+    getattr(preprocess_data, step.func)(*step.args, **step.kwargs)
+    peak_rss = max(resource.getrusage(who).ru_maxrss for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN))
+    return time.monotonic() - started_at, peak_rss * 1024
+
+
+def load_state(state_fpath):
+    if not os.path.exists(state_fpath):
+        return dict()
+    with open(state_fpath, 'r') as f:
+        return json.load(f)
+
+
+def save_state(state, state_fpath):
+    tmp_fpath = state_fpath + '.tmp'
+    with open(tmp_fpath, 'w') as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+    os.replace(tmp_fpath, state_fpath)
+
+
+def _format_bytes(nb_bytes):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if nb_bytes < 1024:
+            return '{:.1f} {}'.format(nb_bytes, unit)
+        nb_bytes /= 1024
+    return '{:.1f} TB'.format(nb_bytes)
+
+
+def run_pipeline(steps, state_fpath, jobs=1, mode=FINGERPRINT_MTIME, force=(), dry_run=False):
+    """
+    Run the steps in dependency order, up to `jobs` at a time, each in its own process. A step is skipped when its
+    inputs, parameters and outputs match the state recorded by its last successful run, unless listed in `force`.
+    Returns the names of the failed steps, their dependents are not run.
+    """
+    state = load_state(state_fpath)
+    producers = {fpath: s.name for s in steps for fpath in s.outputs}
+    depends_on = {s.name: {producers[fpath] for fpath in s.inputs if fpath in producers} - {s.name} for s in steps}
+    pending = {s.name: s for s in steps}
+    done, failed, rerun = set(), set(), set()
+    running = dict()
+    with ProcessPoolExecutor(max_workers=jobs, max_tasks_per_child=1) as executor:
+        while pending or running:
+            for name in list(pending):
+                if depends_on[name] & failed:
+                    print('{}: skipped, a dependency failed'.format(name))
+                    failed.add(name)
+                    del pending[name]
+                    continue
+                if not depends_on[name] <= done or len(running) >= jobs:
+                    continue
+                step = pending.pop(name)
+                key = step_key(step, mode)
+                # a dry run does not rewrite anything, so the dependents of a step that would run are stale too
+                if name not in force and not (dry_run and depends_on[name] & rerun) and \
+                        is_up_to_date(step, state.get(name), key, mode):
+                    print('{}: up to date'.format(name))
+                    done.add(name)
+                    continue
+                missing = [fpath for fpath in step.inputs if not os.path.exists(fpath)]
+                if missing and not (dry_run and depends_on[name] & rerun):
+                    print('{}: missing inputs {}'.format(name, ', '.join(missing)))
+                    failed.add(name)
+                    continue
+                if dry_run:
+                    print('{}: would run'.format(name))
+                    done.add(name)
+                    rerun.add(name)
+                    continue
+                print('{}: running'.format(name))
+                for fpath in step.outputs:
+                    os.makedirs(os.path.dirname(fpath) or '.', exist_ok=True)
+                running[executor.submit(_run_step, step)] = (step, key)
+            if not running:
+                continue
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                step, key = running.pop(future)
+                try:
+                    elapsed, peak_rss = future.result()
+                except Exception as e:
+                    print('{}: failed, err: {}'.format(step.name, e))
+                    failed.add(step.name)
+                    continue
+                print('{}: done in {:.1f}s, peak rss {}'.format(step.name, elapsed, _format_bytes(peak_rss)))
+                state[step.name] = {
+                    'key': key,
+                    'outputs': {fpath: file_fingerprint(fpath, mode) for fpath in step.outputs},
+                    'wall_time': round(elapsed, 3),
+                    'peak_rss': peak_rss,
+                    'finished_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                }
+                save_state(state, state_fpath)
+                done.add(step.name)
+    return failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Run the preprocessing steps whose inputs changed since their last run.')
+    parser.add_argument('--itdk-dir', default='/home/maq18/Projects/Data/ITDK/Base',
+                        help='ITDK base directory, its Tmp and Target siblings are derived from it')
+    parser.add_argument('--igdb-dir', default='/home/maq18/Projects/Data/iGDB')
+    parser.add_argument('--servloc-dir', default='/home/maq18/Projects/Data/ServLoc')
+    parser.add_argument('--state', default=None, help='state file, defaults to {} in the ITDK Target directory'.format(STATE_FNAME))
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='steps run concurrently')
+    parser.add_argument('--workers', type=int, default=1, help='processes used inside the steps that support it')
+    parser.add_argument('--fingerprint', choices=[FINGERPRINT_MTIME, FINGERPRINT_HASH], default=FINGERPRINT_MTIME,
+                        help='detect changed files by size and mtime, or by content hash')
+    parser.add_argument('--force', nargs='*', default=None, help='rerun these steps, or all steps when none is given')
+    parser.add_argument('--dry-run', action='store_true', help='only print the steps that would run')
+    parser.add_argument('--list', action='store_true', help='list the steps with their inputs and outputs')
+    args = parser.parse_args()
+
+    steps = build_steps(args.itdk_dir, args.igdb_dir, args.servloc_dir, workers=args.workers)
+    if args.list:
+        for s in steps:
+            print('{}\n  inputs: {}\n  outputs: {}'.format(s.name, ', '.join(s.inputs), ', '.join(s.outputs)))
+        raise SystemExit(0)
+    force = {s.name for s in steps} if args.force == [] else set(args.force or ())
+    unknown = force - {s.name for s in steps}
+    if unknown:
+        parser.error('unknown steps: {}'.format(', '.join(sorted(unknown))))
+    state_fpath = args.state or os.path.join(args.itdk_dir.replace('Base', 'Target'), STATE_FNAME)
+    os.makedirs(os.path.dirname(state_fpath) or '.', exist_ok=True)
+    failed = run_pipeline(steps, state_fpath, jobs=args.jobs, mode=args.fingerprint, force=force, dry_run=args.dry_run)
+    if failed:
+        print('Failed steps: {}'.format(', '.join(sorted(failed))))
+    raise SystemExit(1 if failed else 0)
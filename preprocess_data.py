@@ -3,17 +3,24 @@ import os
 import csv
 import json
 import rtree
+import heapq
 import random
 import argparse
+import tempfile
 import subprocess
 import numpy as np
 import networkx as nx
 from io import StringIO
+from itertools import islice
+from array import array
 from datetime import datetime
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 from scipy.spatial import KDTree
-from utils.geometry import cluster_by_distance, calc_point_distance, cluster_by_distance_dbscan
+from utils.geometry import cluster_by_distance, calc_point_distance, cluster_by_distance_dbscan, nearest_positions
 from utils.conversion import literal_eval, to_wkt_multilinestring
+from utils.itdk import NodeTable, load_nodes_as, load_nodes_geo
+from utils.routing import CableGraph, CableRouter, LANDCABLE, SUBMARINECABLE, shard_sources
 from shapely.geometry import Point, Polygon
 from shapely.wkt import loads
 
@@ -25,6 +32,9 @@ KEEP_DIGIT_DIM = 4
 MAPPING_FAC_DISTANCE = 30  # km
 MAPPING_CITY_DISTANCE = 80  # km
 MAPPING_LANDING_PTS_DISTANCE = 20  # km
+PROXIMITY_DISTANCE = 20  # km
+AS_BATCH_SIZE = 64  # ASes clustered per process pool task
+WRITE_CHUNK_SIZE = 1 << 20  # nodes formatted at once when writing a per-node file
 
 
 def extract_interdomain_links(node_as_fpath, node_geo_fpath, link_fpath):
@@ -34,37 +44,19 @@ def extract_interdomain_links(node_as_fpath, node_geo_fpath, link_fpath):
     _, node_geo_fname = os.path.split(node_geo_fpath)
     _, link_fname = os.path.split(link_fpath)
     tmp_dir = base_dir.replace('Base', 'Tmp')
-    as_dict = dict()
-    node2as = dict()
-    node2geo = dict()
-    with open(node_as_fpath, 'r') as f:
-        for line in f:
-            if line.startswith('#'):
-                continue
-            starter, nid, asn, tag = line.strip().split()
-            assert starter == 'node.AS'
-            nid = int(nid.strip('N'))
-            asn = int(asn)
-            node2as[nid] = asn
-            as_dict[asn] = 1
+    nids, asns = load_nodes_as(node_as_fpath)
+    node2as = NodeTable(nids, asns)
     print('  {} has {} nodes, representing {} ASes.'.format(
-        node_as_fname, len(node2as), len(as_dict)))
+        node_as_fname, len(node2as), len(np.unique(asns))))
     # load node to geo mapping
-    with open(node_geo_fpath, 'r') as f:
-        for line in f:
-            if line.startswith('#'):
-                continue
-            items = line.strip().split('\t')
-            starter, nid = items[0].strip().split()
-            assert starter == 'node.geo'
-            nid = int(nid.strip('N:'))
-            lat, lon = items[5:7]
-            node2geo[nid] = (float(lat), float(lon))
+    geo_nids, _ = load_nodes_geo(node_geo_fpath)
+    geo_node_ids = np.unique(geo_nids)
     print('  {} has {} nodes with geolocation.'.format(
-        node_geo_fname, len(node2geo)))
+        node_geo_fname, len(geo_node_ids)))
     # get nodes with both AS and geo info
-    node_ids = set(node2as.keys()) & set(node2geo.keys())
-    print('  {} nodes with both AS and geo info.'.format(len(node_ids)))
+    has_geo = np.isin(node2as.keys(), geo_node_ids)
+    node2as = NodeTable(node2as.keys()[has_geo], node2as.values()[has_geo])
+    print('  {} nodes with both AS and geo info.'.format(len(node2as)))
     # sub_node_ids = set()
     nb_useful_links = 0
     with open(link_fpath, 'r') as file1, open(os.path.join(tmp_dir, link_fname), 'w') as file2:
@@ -79,22 +71,22 @@ def extract_interdomain_links(node_as_fpath, node_geo_fpath, link_fpath):
                     member.split(':')[0].strip('N'))
                 member_list.append(node_id)
             member_list = list(set(member_list))
-            asn_list = [node2as[nid] for nid in member_list if nid in node_ids]
+            asn_list = [node2as[nid] for nid in member_list if nid in node2as]
             asn_list = list(set(asn_list))
             if len(asn_list) > 1:
                 nb_useful_links += 1
                 valid_member_list = [
-                    nid for nid in member_list if nid in node_ids]
+                    nid for nid in member_list if nid in node2as]
                 # sub_node_ids.update(valid_member_list)
                 file2.write("link {} {}\n".format(items[1], ' '.join(
                     ['N{}'.format(nid) for nid in valid_member_list])))
     print('  Extracted {} inter-domain links'.format(nb_useful_links))
     # print('Extracted {} inter-domain nodes'.format(len(sub_node_ids)))
-    print('  Extracted {} inter-domain nodes'.format(len(node_ids)))
+    print('  Extracted {} inter-domain nodes'.format(len(node2as)))
     with open(os.path.join(tmp_dir, node_as_fname), 'w') as f:
         # for nid in sub_node_ids:
-        for nid in node_ids:
-            f.write('node.AS N{} {}\n'.format(nid, node2as[nid]))
+        for nid, asn in zip(node2as.keys().tolist(), node2as.values().tolist()):
+            f.write('node.AS N{} {}\n'.format(nid, asn))
     with open(node_geo_fpath, 'r') as file1, open(os.path.join(tmp_dir, node_geo_fname), 'w') as file2:
         for line in file1:
             if line.startswith('#'):
@@ -102,67 +94,95 @@ def extract_interdomain_links(node_as_fpath, node_geo_fpath, link_fpath):
             items = line.strip().split('\t')
             nid = int(items[0].split()[-1].strip('N:'))
             # if nid in sub_node_ids:
-            if nid in node_ids:
+            if nid in node2as:
                 file2.write(line)
 
 
-def group_proximity_nodes(node_as_fpath, node_geo_fpath, link_fpath):
+def _cluster_as_nodes(item):
+    # module level so that a process pool can pickle it, the positions of the AS are shipped along
+    nid_list, node2geo = item
+    return cluster_by_distance(nid_list, node2geo, min_distance=PROXIMITY_DISTANCE)
+
+
+def _cluster_as_batch(items):
+    return [_cluster_as_nodes(item) for item in items]
+
+
+def _iter_as_clusters(nodes_per_as, node2geo, workers=1):
+    # clusters of every AS, in AS order. with several workers the ASes are clustered in a process pool, AS_BATCH_SIZE
+    # ASes per task, and only a few batches are built ahead so the positions of all ASes are never copied at once
+    if workers <= 1:
+        for nid_list in nodes_per_as:
+            yield _cluster_as_nodes((nid_list.tolist(), node2geo))
+        return
+    nodes_per_as = iter(nodes_per_as)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = list()
+        while True:
+            batch = [(nid_list.tolist(), NodeTable(nid_list, node2geo.lookup(nid_list)))
+                     for nid_list in islice(nodes_per_as, AS_BATCH_SIZE)]
+            if not batch:
+                break
+            pending.append(executor.submit(_cluster_as_batch, batch))
+            if len(pending) > 2 * workers:
+                yield from pending.pop(0).result()
+        for future in pending:
+            yield from future.result()
+
+
+def group_proximity_nodes(node_as_fpath, node_geo_fpath, link_fpath, workers=1):
     print('Grouping proximity nodes...')
     tmp_dir, node_as_fname = os.path.split(node_as_fpath)
     _, node_geo_fname = os.path.split(node_geo_fpath)
     _, link_fname = os.path.split(link_fpath)
     target_dir = tmp_dir.replace('Tmp', 'Target')
     # load node to geo mapping
-    node2geo = dict()
-    with open(node_geo_fpath, 'r') as f:
-        for line in f:
-            if line.startswith('#'):
-                continue
-            items = line.strip().split('\t')
-            nid = int(items[0].split()[-1].strip('N:'))
-            lat, lon = items[5:7]
-            node2geo[nid] = np.array([float(lat), float(lon)], dtype=np.double)
-    # load node to AS mapping, group nodes by AS
-    node2as = dict()
-    nodes_per_as = defaultdict(list)
-    with open(node_as_fpath, 'r') as f:
-        for line in f:
-            _, nid, asn = line.strip().split()
-            nid = int(nid.strip('N'))
-            node2as[nid] = int(asn)
-            nodes_per_as[asn].append(nid)
+    geo_nids, positions = load_nodes_geo(node_geo_fpath)
+    node2geo = NodeTable(geo_nids, positions)
+    # load node to AS mapping, group nodes by AS: ASes in order of first appearance, nodes in file order
+    nids, asns = load_nodes_as(node_as_fpath)
+    node2as = NodeTable(nids, asns)
+    _, first, inverse = np.unique(asns, return_index=True, return_inverse=True)
+    as_rank = np.empty(len(first), dtype=np.int64)
+    as_rank[np.argsort(first, kind='stable')] = np.arange(len(first))
+    as_rank = as_rank[inverse.reshape(-1)]
+    nodes_per_as = np.split(nids[np.argsort(as_rank, kind='stable')],
+                            np.cumsum(np.bincount(as_rank, minlength=len(first)))[:-1])
     print('  Loaded {} nodes, {} ASes.'.format(
         len(node2as), len(nodes_per_as)))
     # group nodes within an AS by proximity
     step = 0
-    cluster_mapping = dict()
-    for asn, nid_list in nodes_per_as.items():
-        clusters = cluster_by_distance(nid_list, node2geo, min_distance=20)
+    cluster_heads = np.empty(len(node2as), dtype=np.int64)
+    for clusters in _iter_as_clusters(nodes_per_as, node2geo, workers):
         for cluster in clusters:
-            for nid in cluster:
-                cluster_mapping[nid] = cluster[0]
+            cluster_heads[node2as.index(cluster)] = cluster[0]
         step += 1
         if step % 100 == 0:
             print('  Processed {} ASes.'.format(step))
     del nodes_per_as
-    # write grouped nodes.as
+    cluster_mapping = NodeTable(node2as.keys(), cluster_heads)
+    # write grouped nodes.as, in the order the nodes first appear in the input
     nb_grouped_nodes = 0
+    as_nids = nids[np.sort(np.unique(nids, return_index=True)[1])]
+    is_head = cluster_mapping.lookup(as_nids) == as_nids
     with open(os.path.join(target_dir, node_as_fname), 'w') as f:
-        for nid, asn in node2as.items():
-            if cluster_mapping[nid] == nid:
+        for start in range(0, len(as_nids), WRITE_CHUNK_SIZE):
+            head_nids = as_nids[start:start + WRITE_CHUNK_SIZE][is_head[start:start + WRITE_CHUNK_SIZE]]
+            for nid, asn in zip(head_nids.tolist(), node2as.lookup(head_nids).tolist()):
                 nb_grouped_nodes += 1
                 f.write('node.AS N{} {}\n'.format(nid, asn))
-    # write grouped nodes.geo
+    # write grouped nodes.geo, the lines without comments are in the order of load_nodes_geo
     nb_grouped_nodes = 0
+    is_head = cluster_mapping.lookup(geo_nids) == geo_nids
     with open(node_geo_fpath, 'r') as file1, open(os.path.join(target_dir, node_geo_fname), 'w') as file2:
+        pos = 0
         for line in file1:
             if line.startswith('#'):
                 continue
-            items = line.strip().split('\t')
-            nid = int(items[0].split()[-1].strip('N:'))
-            if cluster_mapping[nid] == nid:
+            if is_head[pos]:
                 nb_grouped_nodes += 1
                 file2.write(line)
+            pos += 1
     print('  Grouped {} nodes'.format(nb_grouped_nodes))
     nb_valid_link = 0
     with open(link_fpath, 'r') as file1, open(os.path.join(target_dir, link_fname), 'w') as file2:
@@ -184,12 +204,7 @@ def group_proximity_nodes(node_as_fpath, node_geo_fpath, link_fpath):
 def remove_redundant_links(link_fpath, node_as_fpath):
     print('Removing redundant links...')
     # load node to AS mapping
-    node2as = dict()
-    with open(node_as_fpath, 'r') as f:
-        for line in f:
-            _, nid, asn = line.strip().split()
-            nid = int(nid.strip('N'))
-            node2as[nid] = int(asn)
+    node2as = NodeTable(*load_nodes_as(node_as_fpath))
     # read link files, format links into tuple format, and remove duplicate links
     target_dir, link_file = os.path.split(link_fpath)
     unique_link_file = link_file.replace('links', 'unique_links')
@@ -276,7 +291,7 @@ def complete_phynode_city_info(city_fpath, facility_fpath):
     print('  Matched fields: {}'.format(nb_fields_matched))
 
 
-def simplify_line_string(landcable_fpath, city_file):
+def simplify_line_string(landcable_fpath, city_file, tolerance=0.1):
     print("Simplifying line string...")
     base_dir, file_name = os.path.split(landcable_fpath)
     simplified_landcable_fpath = os.path.join(
@@ -316,7 +331,6 @@ def simplify_line_string(landcable_fpath, city_file):
             from_city, from_state, from_country, to_city, to_state, to_country, distance_km, path_wkt, asof_date = next(
                 reader)
             linestring = loads(path_wkt)
-            tolerance = 0.1
             simplified = linestring.simplify(
                 tolerance, preserve_topology=False)
             if city_dict.get((from_city, from_state, from_country)) is None or city_dict.get((to_city, to_state, to_country)) is None:
@@ -344,19 +358,12 @@ def simplify_line_string(landcable_fpath, city_file):
         nb_consistent, nb_unconsistent))
 
 
-def map_pop_to_facility(node_geo_fpath, facility_path, node_facility_fpath):
-    print('Mapping PoPs to facility...')
-    # load node to geo mapping
-    node2geo = dict()
-    with open(node_geo_fpath, 'r') as f:
-        for line in f:
-            if line.startswith('#'):
-                continue
-            items = line.strip().split('\t')
-            nid = int(items[0].split()[-1].strip('N:'))
-            lat, lon = items[5:7]
-            node2geo[nid] = np.array([float(lat), float(lon)], dtype=np.double)
-    # load facility geo
+def load_node_geo(node_geo_fpath):
+    # node id -> [lat, lon], the last line of a node wins and keys() are in ascending order
+    return NodeTable(*load_nodes_geo(node_geo_fpath))
+
+
+def load_facility_geo(facility_path):
     facility_geo = list()
     with open(facility_path, 'r') as f:
         next(f)
@@ -368,37 +375,10 @@ def map_pop_to_facility(node_geo_fpath, facility_path, node_facility_fpath):
                 facility_geo.append([float(items[2]), float(items[3])])
             except:
                 continue
-    # map node to facility
-    mapping_res = defaultdict(list)
-    facility_geo = np.array(facility_geo, dtype=np.double)
-    tree = KDTree(facility_geo)
-    for nid, geo in node2geo.items():
-        # extract the nearest 3 facilities to eliminate bias caused by kdtree
-        _, indices = tree.query(geo, k=3)
-        for idx in indices:
-            distance = calc_point_distance(geo, facility_geo[idx])
-            mapping_res[nid].append((idx, distance))
-    # write mapping result
-    with open(node_facility_fpath, 'w') as f:
-        for nid, mapping in sorted(mapping_res.items(), key=lambda x: x[0]):
-            idx, distance = min(mapping, key=lambda x: x[1])
-            f.write('node.Facility N{} F{} {}\n'.format(
-                nid, idx, round(distance, KEEP_DIGITS_DIS)))
+    return np.array(facility_geo, dtype=np.double)
 
 
-def map_pop_to_city(node_geo_fpath, city_fpath, node_city_fpath):
-    print('Mapping PoPs to city...')
-    # load node to geo mapping
-    node2geo = dict()
-    with open(node_geo_fpath, 'r') as f:
-        for line in f:
-            if line.startswith('#'):
-                continue
-            items = line.strip().split('\t')
-            nid = int(items[0].split()[-1].strip('N:'))
-            lat, lon = items[5:7]
-            node2geo[nid] = np.array([float(lat), float(lon)], dtype=np.double)
-    # load city geo
+def load_city_geo(city_fpath):
     city_geo = list()
     with open(city_fpath, 'r') as f:
         next(f)
@@ -410,35 +390,10 @@ def map_pop_to_city(node_geo_fpath, city_fpath, node_city_fpath):
                 city_geo.append([float(items[3]), float(items[4])])
             except:
                 continue
-    # map node to city
-    mapping_res = defaultdict(list)
-    city_geo = np.array(city_geo, dtype=np.double)
-    tree = KDTree(city_geo)
-    for nid, geo in node2geo.items():
-        _, indices = tree.query(geo, k=3)
-        for idx in indices:
-            distance = calc_point_distance(geo, city_geo[idx])
-            mapping_res[nid].append((idx, distance))
-    with open(node_city_fpath, 'w') as f:
-        for nid, mapping in sorted(mapping_res.items(), key=lambda x: x[0]):
-            idx, distance = min(mapping, key=lambda x: x[1])
-            f.write('node.City N{} C{} {}\n'.format(
-                nid, idx, round(distance, KEEP_DIGITS_DIS)))
+    return np.array(city_geo, dtype=np.double)
 
 
-def map_pop_to_landing_points(node_geo_fpath, landing_pts_fpath, node_landing_pts_fpath):
-    print('Mapping PoPs to landing points...')
-    # load node to geo mapping
-    node2geo = dict()
-    with open(node_geo_fpath, 'r') as f:
-        for line in f:
-            if line.startswith('#'):
-                continue
-            items = line.strip().split('\t')
-            nid = int(items[0].split()[-1].strip('N:'))
-            lat, lon = items[5:7]
-            node2geo[nid] = np.array([float(lat), float(lon)], dtype=np.double)
-    # load landing points geo
+def load_landing_points_geo(landing_pts_fpath):
     landing_pts_geo = list()
     with open(landing_pts_fpath, 'r') as f:
         landing_pts_list = json.load(f)
@@ -450,21 +405,54 @@ def map_pop_to_landing_points(node_geo_fpath, landing_pts_fpath, node_landing_pt
             coordinates.reverse()
             assert len(coordinates) == 2
             landing_pts_geo.append(coordinates)
-    landing_pts_geo = np.array(landing_pts_geo, dtype=np.double)
-    tree = KDTree(landing_pts_geo)
-    # map node to landing points
-    mapping_res = defaultdict(list)
-    for nid, geo in node2geo.items():
-        _, indices = tree.query(geo, k=3)
-        for idx in indices:
-            distance = calc_point_distance(geo, landing_pts_geo[idx])
-            mapping_res[nid].append((idx, distance))
-
-    with open(node_landing_pts_fpath, 'w') as f:
-        for nid, mapping in sorted(mapping_res.items(), key=lambda x: x[0]):
-            idx, distance = min(mapping, key=lambda x: x[1])
-            f.write('node.landing_points N{} LP{} {}\n'.format(
-                nid, idx, distance))
+    return np.array(landing_pts_geo, dtype=np.double)
+
+
+def write_node_mapping(fpath, line_format, node2geo, targets, keep_digits=None):
+    # one line per node with its nearest target, all nodes are queried in a single batch
+    indices, distances = nearest_positions(node2geo.values(), targets)
+    if keep_digits is not None:
+        distances = np.round(distances, keep_digits)
+    nids = node2geo.keys()
+    with open(fpath, 'w') as f:
+        for start in range(0, len(nids), WRITE_CHUNK_SIZE):
+            end = start + WRITE_CHUNK_SIZE
+            for nid, idx, distance in zip(nids[start:end].tolist(), indices[start:end].tolist(), distances[start:end].tolist()):
+                f.write(line_format.format(nid, idx, distance))
+
+
+def map_pop_to_facility(node_geo_fpath, facility_path, node_facility_fpath):
+    print('Mapping PoPs to facility...')
+    node2geo = load_node_geo(node_geo_fpath)
+    write_node_mapping(node_facility_fpath, 'node.Facility N{} F{} {}\n',
+                       node2geo, load_facility_geo(facility_path), KEEP_DIGITS_DIS)
+
+
+def map_pop_to_city(node_geo_fpath, city_fpath, node_city_fpath):
+    print('Mapping PoPs to city...')
+    node2geo = load_node_geo(node_geo_fpath)
+    write_node_mapping(node_city_fpath, 'node.City N{} C{} {}\n',
+                       node2geo, load_city_geo(city_fpath), KEEP_DIGITS_DIS)
+
+
+def map_pop_to_landing_points(node_geo_fpath, landing_pts_fpath, node_landing_pts_fpath):
+    print('Mapping PoPs to landing points...')
+    node2geo = load_node_geo(node_geo_fpath)
+    write_node_mapping(node_landing_pts_fpath, 'node.landing_points N{} LP{} {}\n',
+                       node2geo, load_landing_points_geo(landing_pts_fpath))
+
+
+def map_pop_to_locations(node_geo_fpath, facility_path, city_fpath, landing_pts_fpath,
+                         node_facility_fpath, node_city_fpath, node_landing_pts_fpath):
+    # same three files as map_pop_to_facility, map_pop_to_city and map_pop_to_landing_points, nodes.geo is read once
+    print('Mapping PoPs to facility, city and landing points...')
+    node2geo = load_node_geo(node_geo_fpath)
+    write_node_mapping(node_facility_fpath, 'node.Facility N{} F{} {}\n',
+                       node2geo, load_facility_geo(facility_path), KEEP_DIGITS_DIS)
+    write_node_mapping(node_city_fpath, 'node.City N{} C{} {}\n',
+                       node2geo, load_city_geo(city_fpath), KEEP_DIGITS_DIS)
+    write_node_mapping(node_landing_pts_fpath, 'node.landing_points N{} LP{} {}\n',
+                       node2geo, load_landing_points_geo(landing_pts_fpath))
 
 
 def analyze_facility_mapping_distance(node_facility_fpath):
@@ -509,18 +497,48 @@ def analyze_city_mapping_distance(node_city_fpath):
             pcnt, np.percentile(np_dis_arr, pcnt, axis=0)))
 
 
-def map_link2cable(link_fpath, node_as_fpath, node_city_fpath, city_fpath, landcable_fpath, submarinecable_fpath, landing_pts_path, cable_geo_fpath, link_cable_fpath):
+def _link_cable_rows(router, links):
+    # (position, row of unique_links_cable.csv) for the links that have a cable path, in the given order
+    routes = dict()
+    pairs = ((link[-2], link[-1]) for _, link in links)
+    for src_city_idx, dst_city_idx, cables in router.route_pairs(pairs):
+        if cables is not None:
+            landcable_id_list, submarinecable_id_list = cables
+            routes[(src_city_idx, dst_city_idx)] = (
+                ",".join([str(cable_id) for cable_id in landcable_id_list]),
+                ",".join([str(cable_id) for cable_id in submarinecable_id_list]))
+    for pos, (idx, src_nid, dst_nid, src_asn, dst_asn, ltype, src_city_idx, dst_city_idx) in links:
+        route = routes.get((src_city_idx, dst_city_idx))
+        if route is None:
+            continue
+        lcbl_str, scbl_str = route
+        if scbl_str:
+            ltype = "Submarine-cable"
+        elif ltype == "Others":
+            ltype = "Direct"
+        else:
+            ltype = "IXP"
+        yield pos, [idx.strip("L:"), src_nid, dst_nid, src_asn, dst_asn, ltype, lcbl_str, scbl_str]
+
+
+def _map_link2cable_shard(router_prefix, links, shard_fpath):
+    # worker of map_link2cable, the city graph is memory-mapped from the arrays saved by the parent process
+    router = CableRouter.load(router_prefix)
+    nb_links_mapped = 0
+    with open(shard_fpath, 'w') as ofp:
+        writer = csv.writer(ofp, delimiter=',', quotechar='"',
+                            quoting=csv.QUOTE_MINIMAL)
+        for pos, row in _link_cable_rows(router, links):
+            writer.writerow([pos] + row)
+            nb_links_mapped += 1
+    return shard_fpath, nb_links_mapped
+
+
+def map_link2cable(link_fpath, node_as_fpath, node_city_fpath, city_fpath, landcable_fpath, submarinecable_fpath, landing_pts_path, cable_geo_fpath, link_cable_fpath, workers=1):
     print("Mapping link to cable...")
-    # init multi-graph
-    G = nx.MultiGraph()
 
     # load node as info
-    node2as = dict()
-    with open(node_as_fpath, 'r') as f:
-        for line in f:
-            starter, nid, asn = line.strip().split()
-            assert starter == 'node.AS'
-            node2as[int(nid.strip('N'))] = int(asn)
+    node2as = NodeTable(*load_nodes_as(node_as_fpath))
 
     # load city info
     city_geo = list()
@@ -541,8 +559,9 @@ def map_link2cable(link_fpath, node_as_fpath, node_city_fpath, city_fpath, landc
     city_geo = np.array(city_geo, dtype=np.double)
     city_tree = KDTree(city_geo)
 
-    # use city as node in the graph
-    G.add_nodes_from(list(city_lookup.values()))
+    # use city as node in the graph, parallel cables are collapsed into the shortest one
+    city_nodes = set(city_lookup.values())
+    graph = CableGraph(len(city_list))
 
     # load landcable info and use it as edges in the graph
     idx = 0
@@ -555,8 +574,7 @@ def map_link2cable(link_fpath, node_as_fpath, node_city_fpath, city_fpath, landc
                 reader)
             from_pos = city_lookup[(from_city, from_state, from_country)]
             to_pos = city_lookup[(to_city, to_state, to_country)]
-            G.add_edge(from_pos, to_pos, key=f'L{idx}', weight=float(
-                distance_km), type='landcable', cableid=idx)
+            graph.add_edge(from_pos, to_pos, float(distance_km), LANDCABLE, idx)
             idx += 1
 
     # load submarinecable info and use it as edges in the graph
@@ -616,20 +634,18 @@ def map_link2cable(link_fpath, node_as_fpath, node_city_fpath, city_fpath, landc
                                         for landing_point_id in lpts_id_list if landing_point_id in lpts_id2cityidx]
             if len(lpts_mapped_cityidx_list) >= 2:
                 nb_submarine_cables_mapped += 1
-            sub_id = 0
             for i in range(len(lpts_mapped_cityidx_list)):
                 for j in range(i+1, len(lpts_mapped_cityidx_list)):
                     from_pos = lpts_mapped_cityidx_list[i]
                     to_pos = lpts_mapped_cityidx_list[j]
-                    G.add_edge(from_pos, to_pos, key=f'S{idx}-{sub_id}', weight=float(
-                        distance_km), type='submarinecable', cableid=idx)
-                    sub_id += 1
+                    city_nodes.update((from_pos, to_pos))
+                    graph.add_edge(from_pos, to_pos, float(distance_km), SUBMARINECABLE, idx)
             idx += 1
     print("  Mapped {}/{} submarine cables".format(nb_submarine_cables_mapped,
           nb_submarine_cables))
 
     # load node to city index mapping
-    node2cityidx = dict()
+    city_nids, city_indices = array('q'), array('q')
     nb_nodes = 0
     nb_nodes_mapped = 0
     with open(node_city_fpath, 'r') as f:
@@ -640,55 +656,64 @@ def map_link2cable(link_fpath, node_as_fpath, node_city_fpath, city_fpath, landc
             if float(distance) > 80:
                 continue
             nb_nodes_mapped += 1
-            node2cityidx[int(nid.strip('N'))] = int(cityidx.strip('C'))
+            city_nids.append(int(nid.strip('N')))
+            city_indices.append(int(cityidx.strip('C')))
+    node2cityidx = NodeTable(np.frombuffer(city_nids, dtype=np.int64), np.frombuffer(city_indices, dtype=np.int64))
     print("  Mapped {}/{} nodes to city".format(nb_nodes_mapped, nb_nodes))
 
-    # map link to cable
-    idx = 0
+    # load links, the links between two mapped cities are routed together below
+    links = list()
     nb_links = 0
-    nb_links_mapped = 0
-    with open(link_fpath, 'r') as ifp, open(link_cable_fpath, 'w') as ofp:
-        writer = csv.writer(ofp, delimiter=',', quotechar='"',
-                            quoting=csv.QUOTE_MINIMAL)
-        writer.writerow(['link_id', 'src_nid', 'dst_nid', 'src_asn',
-                        'dst_asn', 'link_type', 'landcable_ids', 'submarine_ids'])
+    with open(link_fpath, 'r') as ifp:
         for line in ifp:
             starter, idx, src_nid, dst_nid, ltype = line.strip().split()
             assert starter == 'link'
             nb_links += 1
             src_city_idx = node2cityidx.get(int(src_nid.strip('N')))
             dst_city_idx = node2cityidx.get(int(dst_nid.strip('N')))
+            if src_city_idx not in city_nodes or dst_city_idx not in city_nodes:
+                continue
             src_asn = node2as.get(int(src_nid.strip('N')))
             dst_asn = node2as.get(int(dst_nid.strip('N')))
-            if src_city_idx is not None and dst_city_idx is not None:
+            links.append((nb_links, (idx, src_nid, dst_nid, src_asn, dst_asn, ltype, src_city_idx, dst_city_idx)))
+
+    # map link to cable, one dijkstra per distinct source city instead of one per link
+    router = graph.build()
+    nb_links_mapped = 0
+    with open(link_cable_fpath, 'w') as ofp:
+        writer = csv.writer(ofp, delimiter=',', quotechar='"',
+                            quoting=csv.QUOTE_MINIMAL)
+        writer.writerow(['link_id', 'src_nid', 'dst_nid', 'src_asn',
+                        'dst_asn', 'link_type', 'landcable_ids', 'submarine_ids'])
+        if workers <= 1:
+            for _, row in _link_cable_rows(router, links):
+                writer.writerow(row)
+                nb_links_mapped += 1
+        else:
+            # links are sharded by source city so that every dijkstra runs in a single worker, the workers share
+            # the graph as memory-mapped arrays and their csv shards are merged back in link order
+            with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(link_cable_fpath))) as tmp_dir:
+                router_prefix = os.path.join(tmp_dir, 'city_graph')
+                router.save(router_prefix)
+                nb_shards = 4 * workers
+                shards = shard_sources((link[-2] for _, link in links), nb_shards)
+                shard_links = [list() for _ in range(nb_shards)]
+                for pos, link in links:
+                    shard_links[shards[link[-2]]].append((pos, link))
+                with ProcessPoolExecutor(max_workers=workers) as executor:
+                    futures = [executor.submit(_map_link2cable_shard, router_prefix, shard,
+                                               os.path.join(tmp_dir, 'shard_{}.csv'.format(i)))
+                               for i, shard in enumerate(shard_links) if shard]
+                    results = [future.result() for future in futures]
+                shard_files = [open(shard_fpath, 'r') for shard_fpath, _ in results]
                 try:
-                    path = nx.shortest_path(
-                        G, source=src_city_idx, target=dst_city_idx, weight='weight')
-                    cable_info_list = list()
-                    for u, v in zip(path[:-1], path[1:]):
-                        edge_data = G.get_edge_data(u, v)
-                        min_weight_edge = min(
-                            edge_data.values(), key=lambda x: x['weight'])
-                        cable_info_list.append(min_weight_edge)
-                    landcable_id_list = [cable_info.get(
-                        'cableid') for cable_info in cable_info_list if cable_info.get('type') == 'landcable']
-                    submarinecable_id_list = [cable_info.get(
-                        'cableid') for cable_info in cable_info_list if cable_info.get('type') == 'submarinecable']
-                    if len(submarinecable_id_list) > 0:
-                        ltype = "Submarine-cable"
-                    elif ltype == "Others":
-                        ltype = "Direct"
-                    else:
-                        ltype = "IXP"
-                    lcbl_str = ",".join([str(cable_id)
-                                        for cable_id in landcable_id_list])
-                    scbl_str = ",".join([str(cable_id)
-                                        for cable_id in submarinecable_id_list])
-                    writer.writerow(
-                        [idx.strip("L:"), src_nid, dst_nid, src_asn, dst_asn, ltype, lcbl_str, scbl_str])
-                    nb_links_mapped += 1
-                except:
-                    continue
+                    readers = [csv.reader(shard_file, delimiter=',', quotechar='"') for shard_file in shard_files]
+                    for row in heapq.merge(*readers, key=lambda row: int(row[0])):
+                        writer.writerow(row[1:])
+                finally:
+                    for shard_file in shard_files:
+                        shard_file.close()
+                nb_links_mapped = sum(nb for _, nb in results)
     print("  Mapped {}/{} links".format(nb_links_mapped, nb_links))
 
 
@@ -784,24 +809,10 @@ def map_link2cable(link_fpath, node_as_fpath, node_city_fpath, city_fpath, landc
 def generate_pop_file(node_as_fpath, node_geo_fpath, node_facility_fpath, node_city_fpath, node_landing_pts_fpath, pop_fpath):
     print("Generating PoP file...")
     # load node to AS mapping
-    node2as = dict()
-    with open(node_as_fpath, 'r') as f:
-        for line in f:
-            _, nid, asn = line.strip().split()
-            nid = int(nid.strip('N'))
-            node2as[nid] = int(asn)
+    node2as = NodeTable(*load_nodes_as(node_as_fpath))
 
     # load node to geo mapping
-    node2geo = dict()
-    with open(node_geo_fpath, 'r') as f:
-        for line in f:
-            if line.startswith('#'):
-                continue
-            items = line.strip().split('\t')
-            nid = int(items[0].split()[-1].strip('N:'))
-            lat, lon = items[5:7]
-            node2geo[nid] = [round(float(lat), KEEP_DIGIT_DIM), round(
-                float(lon), KEEP_DIGIT_DIM)]
+    node2geo = NodeTable(*load_nodes_geo(node_geo_fpath))
 
     # node to distance mapping
     # if facility exists, it is the distance between node and facility
@@ -851,9 +862,8 @@ def generate_pop_file(node_as_fpath, node_geo_fpath, node_facility_fpath, node_c
         f.write("idx,asn,lat,lon,facility_id,city_id,landing_id,distance\n")
         writer = csv.writer(f, delimiter=',', quotechar='"',
                             quoting=csv.QUOTE_MINIMAL)
-        for nid in sorted(node2as.keys()):
-            asn = node2as[nid]
-            lat, lon = node2geo[nid]
+        for nid, asn in zip(node2as.keys().tolist(), node2as.values().tolist()):
+            lat, lon = [round(value, KEEP_DIGIT_DIM) for value in node2geo[nid].tolist()]
             facility_id = node2fac[nid]
             city_id = node2city[nid]
             landing_points_id = node2landing[nid]
@@ -1172,23 +1182,16 @@ def transform_submarine_cable_from_ki3(submarinecable_fpath, cable_geo_fpath, ig
 
 
 def count_nb_of_ases_in_interdomain_links(link_fpath, node_as_fpath):
-    node2as = dict()
-    with open(node_as_fpath, 'r') as f:
-        for line in f:
-            if line.startswith('#'):
-                continue
-            _, nid, asn = line.strip().split()
-            node2as[int(nid.strip('N'))] = int(asn)
+    node2as = NodeTable(*load_nodes_as(node_as_fpath))
 
-    as_dict = dict()
+    # the ASes of both ends of every link, looked up in one call
+    link_nids = list()
     with open(link_fpath, 'r') as f:
         for line in f:
             starter, link_id, src_node_id, dst_node_id, link_type = line.strip().split()
-            src_asn = node2as[int(src_node_id.strip('N'))]
-            dst_asn = node2as[int(dst_node_id.strip('N'))]
-            as_dict[src_asn] = True
-            as_dict[dst_asn] = True
-    print('Total ASes: {}'.format(len(as_dict)))
+            link_nids.append(int(src_node_id.strip('N')))
+            link_nids.append(int(dst_node_id.strip('N')))
+    print('Total ASes: {}'.format(len(np.unique(node2as.lookup(link_nids)))))
 
 
 def count_nb_of_links_between_as_tuple(link_cable_fpath):
@@ -1252,6 +1255,7 @@ if __name__ == "__main__":
     node_landing_pts_fpath = os.path.join(
         itdk_target_dir, 'nodes.landing_points')
     # map_pop_to_landing_points(node_geo_fpath, landing_points_fpath, node_landing_pts_fpath)
+    # map_pop_to_locations(node_geo_fpath, complete_facility_fpath, city_fpath, landing_points_fpath, node_facility_fpath, node_city_fpath, node_landing_pts_fpath)
 
     # analyze_facility_mapping_distance(node_facility_fpath)
     # analyze_city_mapping_distance(node_city_fpath)
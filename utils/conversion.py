@@ -1,12 +1,23 @@
 import re
 import csv
 import ast
-from shapely.geometry import MultiLineString
+import numpy as np
+import shapely
+from shapely.geometry import LineString, MultiLineString
 from shapely.wkt import loads, dumps
 from io import StringIO
 from typing import Union
 
 KEEP_DIGITS = 6
+COORD_SCALE = 1e5 # binary coordinates are quantized to 1e-5 degree, about 1 m
+EARTH_RADIUS = 6371.0 # km
+BBOX_EDGE_STEP = 5 # degrees
+POLE_LATITUDE = 89.9999
+LOD_FULL = 'full'
+# Douglas-Peucker tolerances (degrees) of the precomputed cable geometries
+LOD_TOLERANCES = {'high': 0.01, 'medium': 0.1, 'low': 0.5}
+# coarsest level that stays around one pixel at a given web map zoom, as (min zoom, level)
+ZOOM_LODS = ((8, LOD_FULL), (5, 'high'), (2, 'medium'), (0, 'low'))
 
 def to_float(value: Union[str, float]) -> float:
     return round(float(value), KEEP_DIGITS)
@@ -17,6 +28,17 @@ def split_string(s: str):
     reader = csv.reader(fp, delimiter=',', quotechar='"')
     return next(reader)
 
+# split many lines with a single csv reader, one row per line like split_string; a quoted field
+# spanning several lines ends up in the row of its first line and the lines it swallowed get None
+def split_lines(lines):
+    rows = list()
+    reader = csv.reader(lines, delimiter=',', quotechar='"')
+    for row in reader:
+        rows.append(row)
+        rows.extend([None] * (reader.line_num - len(rows)))
+    rows.extend([None] * (len(lines) - len(rows)))
+    return rows
+
 def parse_wkt_multilinestring(wkt: str):
     pattern = r'\(([^()]+)\)'
     matches = re.findall(pattern, wkt)
@@ -36,5 +58,109 @@ def parse_wkt_linestring(wkt_string: str):
     coordinates = list(line.coords)
     return coordinates
 
+# vectorized WKT parsing of (multi)linestrings, a whole column at once; every cable source is a WKT csv column,
+# streamed in bounded chunks by the import engine, so there is neither a WKB reader nor a streaming one here
+def parse_geometries(values):
+    # values that are None or fail to parse give None
+    return shapely.from_wkt(np.asarray(values, dtype=object), on_invalid='ignore')
+
+def split_parts(geoms):
+    # the lines of every geometry: geometry i owns parts[offsets[i]:offsets[i + 1]]
+    parts, index = shapely.get_parts(geoms, return_index=True)
+    offsets = np.zeros(len(geoms) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(index, minlength=len(geoms)), out=offsets[1:])
+    return parts, offsets
+
+def part_coordinates(parts, offsets, tolerance: float = None, as_list: bool = False):
+    # (n, 2) float64 arrays of the lines of every geometry, optionally Douglas-Peucker simplified like simplify_line;
+    # as_list gives [[x, y], ...] lists instead, converted with a single tolist as per-line ones dominate on small lines
+    if tolerance is not None:
+        parts = shapely.simplify(parts, tolerance, preserve_topology=False)
+    coords, index = shapely.get_coordinates(parts, return_index=True)
+    bounds = np.zeros(len(parts) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(index, minlength=len(parts)), out=bounds[1:])
+    if as_list:
+        coords = coords.tolist()
+    bounds = bounds.tolist()
+    lines = [coords[bounds[j]:bounds[j + 1]] for j in range(len(parts))]
+    return [lines[offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1)]
+
+def lines_to_list(lines, multi: bool = True):
+    # same nesting as the documents built from parse_wkt_multilinestring / parse_wkt_linestring
+    if multi:
+        return [line.tolist() for line in lines]
+    return lines[0].tolist()
+
+def encode_coordinates(lines) -> bytes:
+    # little endian int32: number of lines, number of points of every line, then the (lon, lat) of all
+    # points quantized by COORD_SCALE, the first one absolute and the others as deltas to the previous one
+    arrays = [np.asarray(line, dtype=np.float64).reshape(-1, 2) for line in lines]
+    points = np.concatenate(arrays) if arrays else np.empty((0, 2))
+    quantized = np.rint(points * COORD_SCALE).astype(np.int64)
+    deltas = np.diff(quantized, axis=0, prepend=np.zeros((1, 2), dtype=np.int64))
+    header = [len(arrays)] + [len(array) for array in arrays]
+    return np.concatenate([np.asarray(header, dtype=np.int64), deltas.ravel()]).astype('<i4').tobytes()
+
+def decode_coordinates(data: bytes):
+    # (n, 2) float64 arrays of the lines encoded by encode_coordinates
+    values = np.frombuffer(data, dtype='<i4')
+    nb_line = int(values[0])
+    if nb_line == 0:
+        return []
+    counts = values[1:1 + nb_line]
+    points = np.cumsum(values[1 + nb_line:].reshape(-1, 2), axis=0, dtype=np.int64) / COORD_SCALE
+    return np.split(points, np.cumsum(counts)[:-1])
+
 def literal_eval(s: str):
     return ast.literal_eval(s)
+
+def to_geojson_point(latitude: float, longitude: float):
+    # GeoJSON is [longitude, latitude]; out-of-range points are left unindexed instead of failing the insert
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        return None
+    return {'type': 'Point', 'coordinates': [longitude, latitude]}
+
+def _bbox_ring(min_lon: float, min_lat: float, max_lon: float, max_lat: float):
+    # 2dsphere edges are geodesics, so the horizontal edges get a vertex every BBOX_EDGE_STEP
+    # degrees to stay close to the parallels the map viewport is made of
+    nb_step = max(1, int((max_lon - min_lon) // BBOX_EDGE_STEP) + 1)
+    lons = [min_lon + (max_lon - min_lon) * i / nb_step for i in range(nb_step + 1)]
+    ring = [[lon, min_lat] for lon in lons] + [[lon, max_lat] for lon in reversed(lons)]
+    ring.append(ring[0])
+    return [ring]
+
+def bbox_to_polygons(min_lon: float, min_lat: float, max_lon: float, max_lat: float):
+    # all vertices on a pole are the same point, which mongo rejects as duplicate vertices
+    min_lat, max_lat = max(min_lat, -POLE_LATITUDE), min(max_lat, POLE_LATITUDE)
+    if min_lat >= max_lat:
+        raise ValueError('invalid bbox: min latitude must be less than max latitude')
+    # min_lon > max_lon means the box crosses the antimeridian
+    spans = [(min_lon, max_lon)] if min_lon < max_lon else [(min_lon, 180.0), (-180.0, max_lon)]
+    polygons = list()
+    for lon1, lon2 in spans:
+        lon1, lon2 = max(lon1, -180.0), min(lon2, 180.0)
+        # a polygon has to be well within a hemisphere to be unambiguous
+        while lon2 - lon1 > 90:
+            polygons.append(_bbox_ring(lon1, min_lat, lon1 + 90, max_lat))
+            lon1 += 90
+        if lon2 > lon1:
+            polygons.append(_bbox_ring(lon1, min_lat, lon2, max_lat))
+    return [{'type': 'Polygon', 'coordinates': polygon} for polygon in polygons]
+
+def to_bbox(points):
+    # points: iterable of (longitude, latitude)
+    lons, lats = zip(*points)
+    return {'west': min(lons), 'south': min(lats), 'east': max(lons), 'north': max(lats)}
+
+def simplify_line(coords, tolerance: float):
+    # Douglas-Peucker, endpoints are always kept
+    if len(coords) < 3:
+        return [list(point) for point in coords]
+    simplified = LineString(coords).simplify(tolerance, preserve_topology=False)
+    return [list(point) for point in simplified.coords]
+
+def zoom_to_lod(zoom: int) -> str:
+    for min_zoom, lod in ZOOM_LODS:
+        if zoom >= min_zoom:
+            return lod
+    return ZOOM_LODS[-1][1]
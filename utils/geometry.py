@@ -1,9 +1,19 @@
 import numpy as np
 import logging
+from itertools import product
+from scipy.spatial import KDTree
 from sklearn.cluster import DBSCAN
 from asn.models import KEEP_DIGITS
+from utils.conversion import EARTH_RADIUS
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
 
 MIN_CLUSTER_DISTANCE = 50 # km
+PAIRWISE_CHUNK_SIZE = 1024 # rows of a pairwise distance block, bounds the temporaries to chunk x n
+DBSCAN_PARTITION_SIZE = 10000 # point sets larger than this are cut into latitude bands before DBSCAN
+GRID_NEIGHBORS = list(product((-1, 0, 1), repeat=3))
 logger = logging.getLogger("utils.geometry")
 np.set_printoptions(precision=KEEP_DIGITS)
 
@@ -25,41 +35,143 @@ def calc_center_pos(pset, pos_info):
     return np.round(np.array([lat, lng]), KEEP_DIGITS)
 
 
+# batch haversine kernels, positions are [lat, lng] in degrees, one point per row of an (n, 2) array
+def _to_radians(positions, dtype):
+    positions = np.radians(np.asarray(positions, dtype=dtype))
+    return positions[..., 0], positions[..., 1]
+
+
+def _haversine(lat1, lng1, cos_lat1, lat2, lng2, cos_lat2):
+    # inputs in radians and broadcastable, the cosines are passed in so pairwise blocks compute them once
+    a = np.sin((lat2 - lat1) / 2) ** 2 + cos_lat1 * cos_lat2 * np.sin((lng2 - lng1) / 2) ** 2
+    return (2 * EARTH_RADIUS) * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+def haversine_rowwise(positions1, positions2, dtype=np.float64):
+    # distance (km) between positions1[i] and positions2[i], works on single points too
+    lat1, lng1 = _to_radians(positions1, dtype)
+    lat2, lng2 = _to_radians(positions2, dtype)
+    return _haversine(lat1, lng1, np.cos(lat1), lat2, lng2, np.cos(lat2))
+
+
+def haversine_one_to_many(pos, positions, dtype=np.float64):
+    # distance (km) between pos and every row of positions
+    return haversine_rowwise(np.asarray(pos, dtype=dtype)[np.newaxis, :], positions, dtype)
+
+
+def iter_haversine_pairwise(positions1, positions2=None, chunk_size=PAIRWISE_CHUNK_SIZE, dtype=np.float64):
+    # (start, block) with block[i, j] the distance between positions1[start + i] and positions2[j]
+    lat1, lng1 = _to_radians(positions1, dtype)
+    lat2, lng2 = (lat1, lng1) if positions2 is None else _to_radians(positions2, dtype)
+    cos_lat1, cos_lat2 = np.cos(lat1), np.cos(lat2)
+    for start in range(0, len(lat1), chunk_size):
+        end = start + chunk_size
+        yield start, _haversine(lat1[start:end, np.newaxis], lng1[start:end, np.newaxis], cos_lat1[start:end, np.newaxis],
+                                lat2[np.newaxis, :], lng2[np.newaxis, :], cos_lat2[np.newaxis, :])
+
+
+if njit is not None:
+    @njit(parallel=True, cache=True)
+    def _pairwise_numba(lat1, lng1, lat2, lng2, out):
+        for i in prange(lat1.shape[0]):
+            cos_lat1 = np.cos(lat1[i])
+            for j in range(lat2.shape[0]):
+                a = np.sin((lat2[j] - lat1[i]) / 2) ** 2 + cos_lat1 * np.cos(lat2[j]) * np.sin((lng2[j] - lng1[i]) / 2) ** 2
+                out[i, j] = 2 * EARTH_RADIUS * np.arcsin(np.sqrt(min(max(a, 0.0), 1.0)))
+
+
+def haversine_pairwise(positions1, positions2=None, chunk_size=PAIRWISE_CHUNK_SIZE, dtype=np.float64, use_numba=True):
+    # (m, n) distance matrix (km), filled block by block, or by a compiled loop when numba is installed
+    lat1, lng1 = _to_radians(positions1, dtype)
+    lat2, lng2 = (lat1, lng1) if positions2 is None else _to_radians(positions2, dtype)
+    out = np.empty((len(lat1), len(lat2)), dtype=dtype)
+    if use_numba and njit is not None:
+        _pairwise_numba(lat1, lng1, lat2, lng2, out)
+        return out
+    for start, block in iter_haversine_pairwise(positions1, positions2, chunk_size, dtype):
+        out[start:start + len(block)] = block
+    return out
+
+
 def calc_point_distance(pos1:np.array, pos2:np.array):# [lat1, lng1], [lat2, lng2]
-    radius = np.double(6371) # km
-    dlat, dlng = np.radians(pos2 - pos1)
-    a = np.sin(dlat/2) * np.sin(dlat/2) + np.cos(np.radians(pos1[0])) * np.cos(np.radians(pos2[0])) * np.sin(dlng/2) * np.sin(dlng/2)
-    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1-a))
-    d = radius * c
-    return np.round(d, KEEP_DIGITS)
+    return np.round(haversine_rowwise(pos1, pos2), KEEP_DIGITS)
 
 
 def haversine_distance(pos1, pos2):
-    radius=np.double(6371.0)
-    lat1, lon1 = np.radians(pos1)
-    lat2, lon2 = np.radians(pos2)
-    dlat = lat2 - lat1
-    dlon = lon2 - lon1
-    a = np.sin(dlat / 2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon / 2)**2
-    c = 2 * np.arcsin(np.sqrt(a))
-    distance = radius * c
-    return distance
+    return haversine_rowwise(pos1, pos2)
+
+
+def _gather_positions(idx_list, pos_info):
+    # mappings with a vectorized lookup, like utils.itdk.NodeTable, are read in one call instead of one per point
+    lookup = getattr(pos_info, 'lookup', None)
+    if lookup is not None:
+        return np.asarray(lookup(idx_list), dtype=np.double).reshape(-1, 2)
+    return np.array([pos_info[idx] for idx in idx_list], dtype=np.double)
+
+
+def to_unit_vectors(positions):
+    # [lat, lng] in degrees to points of the unit sphere, where the euclidean distance is the chord length
+    lat, lng = _to_radians(positions, np.float64)
+    cos_lat = np.cos(lat)
+    return np.stack([cos_lat * np.cos(lng), cos_lat * np.sin(lng), np.sin(lat)], axis=-1)
+
+
+def chord_length(distance):
+    # chord of the unit sphere under an arc of `distance` km
+    return 2 * np.sin(min(distance / EARTH_RADIUS, np.pi) / 2)
+
+
+def nearest_positions(positions, targets):
+    # index of the nearest target of every position and the distance (km) to it. the nearest point by chord length
+    # on the unit sphere is also the nearest by great circle, so the KDTree on unit vectors is exact everywhere,
+    # near the poles and across the antimeridian included
+    positions = np.asarray(positions, dtype=np.double).reshape(-1, 2)
+    targets = np.asarray(targets, dtype=np.double).reshape(-1, 2)
+    _, indices = KDTree(to_unit_vectors(targets)).query(to_unit_vectors(positions), workers=-1)
+    return indices, calc_point_distance(positions, targets[indices])
 
 
 def cluster_by_distance(idx_list, pos_info, min_distance=MIN_CLUSTER_DISTANCE):
+    # a point joins the first cluster whose head is within min_distance. heads are bucketed in a grid over unit
+    # vectors whose cells are as wide as the chord of min_distance (plus a margin for the rounding of distances),
+    # so only the heads of the 27 cells around a point can be close enough and they are checked in one batch
     clusters = []
-    for idx in idx_list:
-        found = False
-        for cluster in clusters:
-            if calc_point_distance(pos_info[idx], pos_info[cluster[0]]) < min_distance:
-                cluster.append(idx)
-                found = True
-                break
-        if not found:
-            clusters.append([idx])
+    if len(idx_list) == 0:
+        return clusters
+    positions = _gather_positions(idx_list, pos_info)
+    cells = np.floor(to_unit_vectors(positions) / chord_length(min_distance + 1e-3)).astype(np.int64).tolist()
+    heads = np.empty(len(idx_list), dtype=np.int64)
+    grid = dict()
+    for i, idx in enumerate(idx_list):
+        x, y, z = cells[i]
+        candidates = [head for dx, dy, dz in GRID_NEIGHBORS for head in grid.get((x + dx, y + dy, z + dz), ())]
+        if candidates:
+            distances = np.round(haversine_one_to_many(positions[i], positions[heads[candidates]]), KEEP_DIGITS)
+            close = np.flatnonzero(distances < min_distance)
+            if len(close):
+                clusters[min(candidates[j] for j in close)].append(idx)
+                continue
+        heads[len(clusters)] = i
+        grid.setdefault((x, y, z), []).append(len(clusters))
+        clusters.append([idx])
     return clusters
 
-def cluster_by_distance_dbscan(idx_list, pos_info, min_distance=MIN_CLUSTER_DISTANCE):
+
+def _dbscan_labels(positions, min_distance):
+    # sklearn's compiled haversine on radians, eps is the central angle of min_distance
+    db = DBSCAN(eps=min_distance / EARTH_RADIUS, min_samples=1, metric='haversine', algorithm='ball_tree')
+    return db.fit(np.radians(positions)).labels_
+
+
+def _latitude_bands(positions, min_distance):
+    # two points are at least as far apart as their latitudes along a meridian, so cutting the sorted
+    # latitudes at every gap wider than min_distance gives bands that can be clustered independently
+    order = np.argsort(positions[:, 0], kind='stable')
+    gaps = np.flatnonzero(np.diff(positions[order, 0]) > np.degrees(min_distance / EARTH_RADIUS))
+    return np.split(order, gaps + 1)
+
+
+def cluster_by_distance_dbscan(idx_list, pos_info, min_distance=MIN_CLUSTER_DISTANCE, partition_size=DBSCAN_PARTITION_SIZE):
     # check if empty
     if len(idx_list) == 0:
         return []
@@ -67,12 +179,16 @@ def cluster_by_distance_dbscan(idx_list, pos_info, min_distance=MIN_CLUSTER_DIST
     if len(idx_list) == 1:
         return [idx_list]
     # extract positions
-    positions = np.array([pos_info[idx] for idx in idx_list])
-    # use DBSCAN for clustering
-    db = DBSCAN(eps=min_distance, min_samples=1, metric=calc_point_distance).fit(positions)
-    # get labels
-    labels = db.labels_
-    # create clusters
+    positions = _gather_positions(idx_list, pos_info)
+    # use DBSCAN for clustering, band by band for large point sets
+    bands = _latitude_bands(positions, min_distance) if len(idx_list) > partition_size else [np.arange(len(idx_list))]
+    labels = np.empty(len(idx_list), dtype=np.int64)
+    nb_label = 0
+    for band in bands:
+        band_labels = _dbscan_labels(positions[band], min_distance) if len(band) > 1 else np.zeros(1, dtype=np.int64)
+        labels[band] = band_labels + nb_label
+        nb_label += band_labels.max() + 1
+    # create clusters, ordered by their first point like DBSCAN numbers them
     clusters = {}
     for idx, label in zip(idx_list, labels):
         if label not in clusters:
@@ -0,0 +1,218 @@
+import os
+import json
+import hashlib
+import logging
+import numpy as np
+from array import array
+
+
+logger = logging.getLogger('utils.itdk')
+CACHE_SUFFIX = '.cache' # the parsed arrays of nodes.geo are kept in nodes.geo.cache/
+CACHE_VERSION = 1
+HASH_CHUNK_BYTES = 1 << 20
+
+
+def file_hash(fpath):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(fpath, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_BYTES), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def parse_nodes_geo(fpath):
+    # node.geo N1:<tab>continent<tab>country<tab>region<tab>city<tab>lat<tab>lon<tab>...
+    nids, lats, lons = array('q'), array('d'), array('d')
+    with open(fpath, 'r') as f:
+        for line in f:
+            if line.startswith('#'):
+                continue
+            items = line.strip().split('\t')
+            starter, nid = items[0].split()
+            assert starter == 'node.geo'
+            nids.append(int(nid.strip('N:')))
+            lats.append(float(items[5]))
+            lons.append(float(items[6]))
+    positions = np.empty((len(nids), 2), dtype=np.float64)
+    positions[:, 0] = np.frombuffer(lats, dtype=np.float64)
+    positions[:, 1] = np.frombuffer(lons, dtype=np.float64)
+    return {'nids': np.frombuffer(nids, dtype=np.int64).copy(), 'positions': positions}
+
+
+def parse_nodes_as(fpath):
+    # node.AS N1 <asn> [<method>], the method column is only present in the raw ITDK file
+    nids, asns = array('q'), array('I')
+    with open(fpath, 'r') as f:
+        for line in f:
+            if line.startswith('#'):
+                continue
+            items = line.split()
+            assert items[0] == 'node.AS'
+            nids.append(int(items[1].strip('N')))
+            asns.append(int(items[2]))
+    return {'nids': np.frombuffer(nids, dtype=np.int64).copy(),
+            'asns': np.frombuffer(asns, dtype=np.uint32).copy()}
+
+
+def _read_cache(fpath, kind, fields, mmap_mode):
+    cache_dir = fpath + CACHE_SUFFIX
+    meta_fpath = os.path.join(cache_dir, 'meta.json')
+    try:
+        with open(meta_fpath, 'r') as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if meta.get('version') != CACHE_VERSION or meta.get('kind') != kind:
+        return None
+    stat = os.stat(fpath)
+    if meta['size'] != stat.st_size:
+        return None
+    if meta['mtime_ns'] != stat.st_mtime_ns:
+        # touched or copied, the content decides
+        if meta['hash'] != file_hash(fpath):
+            return None
+        meta['mtime_ns'] = stat.st_mtime_ns
+        _write_meta(meta_fpath, meta)
+    try:
+        return {field: np.load(os.path.join(cache_dir, f'{field}.npy'), mmap_mode=mmap_mode) for field in fields}
+    except (OSError, ValueError) as e:
+        logger.warning(f"Ignore the broken cache of {fpath}, err: {e}")
+        return None
+
+
+def _write_meta(meta_fpath, meta):
+    tmp_fpath = f'{meta_fpath}.{os.getpid()}.tmp'
+    with open(tmp_fpath, 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmp_fpath, meta_fpath)
+
+
+def _write_cache(fpath, kind, arrays):
+    # the meta file is written last, a cache without it is never read
+    cache_dir = fpath + CACHE_SUFFIX
+    meta_fpath = os.path.join(cache_dir, 'meta.json')
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        if os.path.exists(meta_fpath):
+            os.remove(meta_fpath)
+        stat = os.stat(fpath)
+        for field, values in arrays.items():
+            # replaced atomically, a concurrent step may be memory-mapping the previous file
+            array_fpath = os.path.join(cache_dir, f'{field}.npy')
+            with open(f'{array_fpath}.{os.getpid()}.tmp', 'wb') as f:
+                np.save(f, values)
+            os.replace(f'{array_fpath}.{os.getpid()}.tmp', array_fpath)
+        _write_meta(meta_fpath, {'version': CACHE_VERSION, 'kind': kind, 'hash': file_hash(fpath),
+                                 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns})
+    except OSError as e:
+        logger.warning(f"Failed to cache {fpath}, err: {e}")
+
+
+def _load(fpath, kind, parser, fields, cache, mmap_mode):
+    if cache:
+        arrays = _read_cache(fpath, kind, fields, mmap_mode)
+        if arrays is not None:
+            return tuple(arrays[field] for field in fields)
+    arrays = parser(fpath)
+    if cache:
+        _write_cache(fpath, kind, arrays)
+    return tuple(arrays[field] for field in fields)
+
+
+def load_nodes_geo(fpath, cache=True, mmap_mode='r'):
+    """
+    Node ids (int64) and [lat, lon] rows (float64) of an ITDK nodes.geo file, in file order. The arrays are cached as
+    .npy files next to the source, keyed by its content hash, and memory-mapped by later calls.
+    """
+    return _load(fpath, 'nodes.geo', parse_nodes_geo, ('nids', 'positions'), cache, mmap_mode)
+
+
+def load_nodes_as(fpath, cache=True, mmap_mode='r'):
+    """
+    Node ids (int64) and ASNs (uint32) of an ITDK nodes.as file, in file order, cached like load_nodes_geo.
+    """
+    return _load(fpath, 'nodes.as', parse_nodes_as, ('nids', 'asns'), cache, mmap_mode)
+
+
+class NodeTable:
+    """
+    Read-only mapping of node id -> value backed by numpy arrays instead of a dict of python objects, for the tens
+    of millions of ITDK nodes. `values` holds one value or one row (e.g. [lat, lon]) per node; when an id is given
+    more than once the last one wins, like assigning into a dict. Ids are kept sorted and looked up with
+    searchsorted, or with a dense id -> position array when the ids are compact (ITDK numbers its nodes 1..N).
+
+        node_geo = NodeTable(*load_nodes_geo(node_geo_fpath))
+        lat, lon = node_geo[nid]
+        positions = node_geo.lookup(nid_list)
+    """
+    DENSE_RATIO = 2 # use the dense index when max id < DENSE_RATIO * number of nodes
+
+    def __init__(self, nids, values):
+        nids = np.asarray(nids, dtype=np.int64)
+        values = np.asarray(values)
+        assert len(nids) == len(values)
+        # the stable sort keeps the occurrences of an id in file order, the last of each run is kept
+        order = np.argsort(nids, kind='stable')
+        ids = nids[order]
+        last = np.ones(len(ids), dtype=bool)
+        last[:-1] = ids[1:] != ids[:-1]
+        self._ids = ids[last]
+        self._values = values[order[last]]
+        self._dense = None
+        if len(self._ids) and self._ids[0] >= 0 and self._ids[-1] < self.DENSE_RATIO * len(self._ids):
+            self._dense = np.full(self._ids[-1] + 1, -1, dtype=np.int64)
+            self._dense[self._ids] = np.arange(len(self._ids))
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __iter__(self):
+        return iter(self._ids.tolist())
+
+    def __contains__(self, nid):
+        return self._position(nid) >= 0
+
+    def __getitem__(self, nid):
+        pos = self._position(nid)
+        if pos < 0:
+            raise KeyError(nid)
+        return self._values[pos]
+
+    def _position(self, nid):
+        if self._dense is not None:
+            return self._dense[nid] if 0 <= nid < len(self._dense) else -1
+        pos = self._ids.searchsorted(nid)
+        return pos if pos < len(self._ids) and self._ids[pos] == nid else -1
+
+    def get(self, nid, default=None):
+        pos = self._position(nid)
+        return default if pos < 0 else self._values[pos]
+
+    def keys(self):
+        return self._ids
+
+    def values(self):
+        return self._values
+
+    def items(self):
+        return zip(self._ids.tolist(), self._values)
+
+    def index(self, nids):
+        # positions of nids in keys(), -1 for the unknown ones
+        nids = np.asarray(nids, dtype=np.int64)
+        if self._dense is not None:
+            known = (nids >= 0) & (nids < len(self._dense))
+            positions = np.full(nids.shape, -1, dtype=np.int64)
+            positions[known] = self._dense[nids[known]]
+            return positions
+        if len(self._ids) == 0:
+            return np.full(nids.shape, -1, dtype=np.int64)
+        positions = np.minimum(self._ids.searchsorted(nids), len(self._ids) - 1)
+        return np.where(self._ids[positions] == nids, positions, -1)
+
+    def lookup(self, nids):
+        # values of nids in one call, KeyError if one of them is unknown
+        positions = self.index(nids)
+        if (positions < 0).any():
+            raise KeyError(np.asarray(nids)[positions < 0][0].item())
+        return self._values[positions]
@@ -0,0 +1,127 @@
+import logging
+import numpy as np
+from collections import defaultdict
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+
+
+logger = logging.getLogger('utils.routing')
+LANDCABLE = 0
+SUBMARINECABLE = 1
+CABLE_TYPES = ('landcable', 'submarinecable')
+SOURCE_CHUNK_SIZE = 64 # sources per dijkstra call, bounds the (chunk, nb_node) distance and predecessor matrices
+
+
+class CableGraph:
+    """
+    Undirected graph of cities whose edges are cables. Parallel cables between two cities are collapsed into the
+    lightest one and the first added wins a tie, like min() over the edge data of a networkx MultiGraph.
+
+        graph = CableGraph(len(city_list))
+        graph.add_edge(from_pos, to_pos, float(distance_km), LANDCABLE, idx)
+        router = graph.build()
+    """
+
+    def __init__(self, nb_node):
+        self.nb_node = nb_node
+        self.__edges = dict() # (u, v) with u < v -> (weight, cable_type, cable_id)
+
+    def __len__(self):
+        return len(self.__edges)
+
+    def add_edge(self, u, v, weight, cable_type, cable_id):
+        if u == v:
+            # a loop is never part of a shortest path
+            return
+        key = (u, v) if u < v else (v, u)
+        edge = self.__edges.get(key)
+        if edge is None or weight < edge[0]:
+            self.__edges[key] = (weight, cable_type, cable_id)
+
+    def build(self):
+        # both directions are stored, so the csr row of a city lists all its neighbours
+        nb_edge = len(self.__edges)
+        rows = np.empty(2 * nb_edge, dtype=np.int32)
+        cols = np.empty(2 * nb_edge, dtype=np.int32)
+        weights = np.empty(2 * nb_edge, dtype=np.double)
+        cable_types = np.empty(2 * nb_edge, dtype=np.int8)
+        cable_ids = np.empty(2 * nb_edge, dtype=np.int64)
+        for i, ((u, v), (weight, cable_type, cable_id)) in enumerate(self.__edges.items()):
+            rows[2 * i], cols[2 * i], rows[2 * i + 1], cols[2 * i + 1] = u, v, v, u
+            weights[2 * i:2 * i + 2] = weight
+            cable_types[2 * i:2 * i + 2] = cable_type
+            cable_ids[2 * i:2 * i + 2] = cable_id
+        order = np.lexsort((cols, rows))
+        indptr = np.zeros(self.nb_node + 1, dtype=np.int32)
+        np.cumsum(np.bincount(rows, minlength=self.nb_node), out=indptr[1:])
+        return CableRouter(indptr, cols[order], weights[order], cable_types[order], cable_ids[order])
+
+
+class CableRouter:
+    """
+    Shortest cable paths over the csr arrays of a CableGraph. The arrays may be memory-mapped, see save / load.
+    Every distinct source runs a single dijkstra, sources are processed in chunks of `chunk_size`.
+    """
+    ARRAYS = ('indptr', 'indices', 'weights', 'cable_types', 'cable_ids')
+
+    def __init__(self, indptr, indices, weights, cable_types, cable_ids):
+        self.indptr = indptr
+        self.indices = indices
+        self.weights = weights
+        self.cable_types = cable_types
+        self.cable_ids = cable_ids
+        self.nb_node = len(indptr) - 1
+        # explicit zeros are kept by csr_matrix, so zero length cables stay edges
+        self.matrix = csr_matrix((weights, indices, indptr), shape=(self.nb_node, self.nb_node))
+
+    def save(self, prefix):
+        for name in self.ARRAYS:
+            np.save(f'{prefix}.{name}.npy', getattr(self, name))
+
+    @classmethod
+    def load(cls, prefix, mmap_mode='r'):
+        return cls(*[np.load(f'{prefix}.{name}.npy', mmap_mode=mmap_mode) for name in cls.ARRAYS])
+
+    def _edge(self, u, v):
+        # the neighbours of a row are sorted, so the edge is found by bisection
+        start, end = self.indptr[u], self.indptr[u + 1]
+        pos = start + np.searchsorted(self.indices[start:end], v)
+        return self.cable_types[pos], self.cable_ids[pos]
+
+    def _cables(self, predecessors, src, dst):
+        # walk the predecessor tree back from dst, cable ids are returned in path order from src
+        landcable_ids, submarinecable_ids = list(), list()
+        v = dst
+        while v != src:
+            u = predecessors[v]
+            cable_type, cable_id = self._edge(u, v)
+            (submarinecable_ids if cable_type == SUBMARINECABLE else landcable_ids).append(int(cable_id))
+            v = u
+        landcable_ids.reverse()
+        submarinecable_ids.reverse()
+        return landcable_ids, submarinecable_ids
+
+    def route_pairs(self, pairs, chunk_size=SOURCE_CHUNK_SIZE):
+        """
+        Yield (src, dst, cables) for every distinct (src, dst) node pair, grouped by source, where cables is
+        (landcable_ids, submarinecable_ids) along the shortest path, or None when dst can not be reached.
+        """
+        targets = defaultdict(set)
+        for src, dst in pairs:
+            targets[src].add(dst)
+        sources = sorted(targets)
+        for start in range(0, len(sources), chunk_size):
+            chunk = sources[start:start + chunk_size]
+            distances, predecessors = dijkstra(self.matrix, directed=True, indices=chunk, return_predecessors=True)
+            for row, src in enumerate(chunk):
+                for dst in sorted(targets[src]):
+                    if not np.isfinite(distances[row, dst]):
+                        yield src, dst, None
+                        continue
+                    yield src, dst, self._cables(predecessors[row], src, dst)
+
+
+def shard_sources(sources, nb_shard):
+    # {source: shard} spreading the distinct sources evenly, every dijkstra visits the whole graph
+    # so the work of a shard is about its number of sources
+    return {src: i % nb_shard for i, src in enumerate(sorted(set(sources)))}